@@ -0,0 +1,222 @@
+#! /usr/bin/env python
+#  -*- coding: utf-8 -*-
+#
+# This file is part of nakivo_prometheus_exporter
+
+__appname__ = "nakivo_prometheus_exporter"
+__author__ = "Orsiris de Jong"
+__site__ = "https://www.github.com/netinvent/nakivo_prometheus_exporter"
+__description__ = "Naviko API Prometheus data exporter"
+__copyright__ = "Copyright (C) 2024 NetInvent"
+__license__ = "GPL-3.0-only"
+__build__ = "2026101701"
+
+
+import os
+import sys
+import json
+import time
+import tempfile
+import threading
+import tracemalloc
+import multiprocessing
+from argparse import ArgumentParser
+from typing import Callable, List, Tuple
+from ruamel.yaml import YAML
+
+# Fix dev env module import
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from nakivo_prometheus_exporter.fake_nakivo import FakeNakivo
+from nakivo_prometheus_exporter.prom_parser import (
+    get_nakivo_data,
+    collect_nakivo_hosts,
+)
+from nakivo_prometheus_exporter.exposition import iter_format
+
+
+def percentile(values: List[float], percent: float) -> float:
+    """
+    Nearest rank percentile
+    """
+    if not values:
+        return 0
+    ordered = sorted(values)
+    rank = max(int(round(percent / 100 * len(ordered) + 0.5)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+def _serve_fake_director(jobs: int, objects: int, latency: float, queue) -> None:
+    server = FakeNakivo(jobs, objects, latency).start()
+    queue.put(server.url)
+    # Serve until terminated
+    threading.Event().wait()
+
+
+def start_fake_director(
+    jobs: int, objects: int, latency: float
+) -> Tuple[multiprocessing.Process, str]:
+    """
+    Runs a fake Nakivo director in its own process, so building and serializing its replies
+    doesn't count in the exporter's CPU time and memory
+    Returns the process and the director's url
+    """
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(
+        target=_serve_fake_director,
+        args=(jobs, objects, latency, queue),
+        name="fake_nakivo",
+        daemon=True,
+    )
+    process.start()
+    return process, queue.get(timeout=30)
+
+
+def measure(function: Callable, iterations: int) -> dict:
+    """
+    Runs function repeatedly, returns latency percentiles, CPU time per run and peak traced memory
+    Peak memory is measured on an extra run, since tracing allocations slows everything down
+    Both only account for this process, fake directors run in their own processes
+    """
+    latencies = []
+    cpu_start = time.process_time()
+    for _ in range(iterations):
+        start = time.perf_counter()
+        function()
+        latencies.append(time.perf_counter() - start)
+    cpu = (time.process_time() - cpu_start) / max(iterations, 1)
+
+    tracemalloc.start()
+    try:
+        function()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {
+        "iterations": iterations,
+        "p50": percentile(latencies, 50),
+        "p90": percentile(latencies, 90),
+        "p99": percentile(latencies, 99),
+        "max": max(latencies) if latencies else 0,
+        "cpu": cpu,
+        "peak_memory_mb": peak / 1048576,
+    }
+
+
+def benchmark_endpoint(config: dict, iterations: int, headers: dict) -> dict:
+    """
+    Benchmarks the /metrics endpoint in live mode, through FastAPI's test client
+    """
+    try:
+        from fastapi.testclient import TestClient
+    except (ImportError, RuntimeError):
+        # Test client needs httpx, which isn't an exporter dependency
+        return {"error": "/metrics benchmark requires httpx (pip install httpx)"}
+
+    with tempfile.NamedTemporaryFile(
+        "w", suffix=".yaml", delete=False, encoding="utf-8"
+    ) as file_handle:
+        YAML().dump(config, file_handle)
+        config_file = file_handle.name
+    # metrics module loads its configuration from command line on import
+    argv = sys.argv
+    sys.argv = [argv[0], "-c", config_file]
+    try:
+        from nakivo_prometheus_exporter import metrics
+    finally:
+        sys.argv = argv
+        os.unlink(config_file)
+
+    client = TestClient(metrics.app)
+
+    def _scrape():
+        response = client.get("/metrics", headers=headers)
+        if response.status_code != 200:
+            raise RuntimeError(f"/metrics replied {response.status_code}")
+
+    return measure(_scrape, iterations)
+
+
+def print_result(title: str, result: dict) -> None:
+    if "error" in result:
+        print(f"{title:<28} {result['error']}")
+        return
+    print(
+        f"{title:<28} p50 {result['p50'] * 1000:9.1f}ms  p90 {result['p90'] * 1000:9.1f}ms  "
+        f"p99 {result['p99'] * 1000:9.1f}ms  max {result['max'] * 1000:9.1f}ms  "
+        f"cpu {result['cpu'] * 1000:9.1f}ms/run  peak {result['peak_memory_mb']:8.1f}MB"
+    )
+
+
+def main():
+    parser = ArgumentParser(
+        prog=f"{__appname__}.benchmark",
+        description="Benchmarks Nakivo collection and /metrics against local fake Nakivo directors",
+    )
+    parser.add_argument("--hosts", type=int, default=2, help="Fake Nakivo directors")
+    parser.add_argument("--jobs", type=int, default=50, help="Jobs per director")
+    parser.add_argument("--objects", type=int, default=20, help="Objects per job")
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.01,
+        help="Seconds every fake API call waits before replying",
+    )
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument(
+        "--encoding", type=str, default=None, help="Accept-Encoding sent to /metrics"
+    )
+    parser.add_argument(
+        "--no-endpoint", action="store_true", help="Don't benchmark /metrics"
+    )
+    parser.add_argument("--json", action="store_true", help="Output results as JSON")
+    args = parser.parse_args()
+
+    servers = [
+        start_fake_director(args.jobs, args.objects, args.latency)
+        for _ in range(args.hosts)
+    ]
+    host_configs = [
+        {
+            f"Fake{index}": None,
+            "host": url,
+            "username": "benchmark",
+            "password": "benchmark",
+            "cert_verify": False,
+        }
+        for index, (_, url) in enumerate(servers)
+    ]
+    results = {}
+    try:
+        results["get_nakivo_data"] = measure(
+            lambda: get_nakivo_data(host_configs[0]), args.iterations
+        )
+        results["collect_and_render"] = measure(
+            lambda: b"".join(iter_format(collect_nakivo_hosts(host_configs))),
+            args.iterations,
+        )
+        if not args.no_endpoint:
+            config = {
+                "http_server": {"no_auth": True},
+                "collector": {"background": False},
+                "nakivo_hosts": host_configs,
+            }
+            headers = {"Accept-Encoding": args.encoding or "identity"}
+            results["/metrics"] = benchmark_endpoint(config, args.iterations, headers)
+    finally:
+        for process, _ in servers:
+            process.terminate()
+            process.join()
+
+    if args.json:
+        print(json.dumps({"parameters": vars(args), "results": results}, indent=2))
+        return
+    print(
+        f"{args.hosts} hosts x {args.jobs} jobs x {args.objects} objects, "
+        f"{args.latency * 1000:.0f}ms API latency, {args.iterations} iterations"
+    )
+    for title, result in results.items():
+        print_result(title, result)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,364 @@
+#! /usr/bin/env python
+#  -*- coding: utf-8 -*-
+#
+# This file is part of nakivo_prometheus_exporter
+
+__appname__ = "nakivo_prometheus_exporter"
+__author__ = "Orsiris de Jong"
+__site__ = "https://www.github.com/netinvent/nakivo_prometheus_exporter"
+__description__ = "Naviko API Prometheus data exporter"
+__copyright__ = "Copyright (C) 2024 NetInvent"
+__license__ = "GPL-3.0-only"
+__build__ = "2026101701"
+
+
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, List, Optional
+from pathlib import Path
+from logging import getLogger
+from nakivo_prometheus_exporter.prom_parser import (
+    get_nakivo_data,
+    get_host_label,
+    add_host_status,
+    get_stale_data,
+    DEFAULT_MAX_CONCURRENCY,
+    DEFAULT_HOST_TIMEOUT,
+)
+from nakivo_prometheus_exporter.exposition import (
+    MetricSet,
+    RenderCache,
+    iter_format,
+    EXPOSITION_FORMATS,
+)
+from nakivo_prometheus_exporter.shared_store import SnapshotStore, LeaderLock
+from nakivo_prometheus_exporter.self_metrics import self_metrics
+
+logger = getLogger()
+
+# How often (seconds) a Nakivo host is collected in background
+DEFAULT_COLLECT_INTERVAL = 300
+# How often (seconds) a worker checks whether it should take over collection
+LEADER_RETRY_INTERVAL = 5
+
+
+def get_background_collection(config: dict) -> bool:
+    """
+    Returns whether /metrics serves a background collected snapshot (default) or scrapes live
+    """
+    try:
+        return config["collector"]["background"] is not False
+    except (AttributeError, ValueError, TypeError, KeyError):
+        return True
+
+
+def get_collect_interval(config: dict) -> float:
+    """
+    Returns default collection interval from the collector config section
+    """
+    try:
+        return float(config["collector"]["interval"])
+    except (AttributeError, ValueError, TypeError, KeyError):
+        return DEFAULT_COLLECT_INTERVAL
+
+
+class Collector:
+    """
+    Collects Nakivo hosts in background threads, each host on its own interval,
+    and keeps the last rendered prometheus snapshot so it can be served right away
+
+    When a store directory is given, only the worker process holding the leader lock
+    collects, and other workers serve the snapshot it writes to the shared store
+    """
+
+    def __init__(
+        self,
+        host_configs: List[dict],
+        max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+        host_timeout: float = DEFAULT_HOST_TIMEOUT,
+        interval: float = DEFAULT_COLLECT_INTERVAL,
+        store_dir: Optional[Path] = None,
+        streaming: bool = False,
+        encodings: Optional[List[str]] = None,
+        formats: Optional[List[str]] = None,
+    ):
+        self.host_configs = list(host_configs)
+        self.max_concurrency = max_concurrency
+        self.host_timeout = host_timeout
+        self.interval = interval
+        # When streaming, the rendered snapshot only lives in the shared store
+        self.streaming = streaming and bool(store_dir)
+        # Compressed snapshots are stored along the plain one
+        self.encodings = list(encodings) if encodings and store_dir else []
+        # Every exposition format we serve is rendered once per collection
+        self.formats = list(formats) if formats else ["text"]
+
+        # Per host label: last collection result, running collection start, next run
+        self._results = {}
+        self._started = {}
+        self._next_run = {
+            get_host_label(host_config): 0 for host_config in self.host_configs
+        }
+        self._snapshots = {}
+        # Hosts whose data didn't change since last render reuse their rendered samples
+        self._render_cache = RenderCache()
+        # A worker taking over collection keeps serving the previous leader's snapshot
+        # until every host has been collected again, instead of publishing partial data
+        self._hold_render = False
+
+        if store_dir:
+            self._store = SnapshotStore(store_dir)
+            self._leader = LeaderLock(store_dir)
+        else:
+            self._store = None
+            self._leader = None
+
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._executor = None
+
+    @property
+    def snapshot(self) -> bytes:
+        """
+        Last rendered prometheus data
+        """
+        return self.get_snapshot()
+
+    def _use_store(self, encoding: Optional[str], exposition_format: str) -> bool:
+        return bool(
+            encoding
+            or self.streaming
+            or (self._leader and not self._leader.acquired)
+            # A new leader serves the previous leader's snapshot until it rendered its own
+            or (self._store and exposition_format not in self._snapshots)
+        )
+
+    def get_snapshot(
+        self, encoding: Optional[str] = None, exposition_format: str = "text"
+    ) -> bytes:
+        """
+        Last rendered prometheus data, optionally compressed with one of our encodings
+        """
+        name = EXPOSITION_FORMATS[exposition_format]["file"]
+        if self._use_store(encoding, exposition_format):
+            return self._store.read(self._store.get_name(name, encoding))
+        return self._snapshots.get(exposition_format, b"")
+
+    def iter_snapshot(
+        self, encoding: Optional[str] = None, exposition_format: str = "text"
+    ) -> Iterator[bytes]:
+        """
+        Streams last rendered prometheus data in chunks
+        """
+        name = EXPOSITION_FORMATS[exposition_format]["file"]
+        if self._use_store(encoding, exposition_format):
+            return self._store.iter_chunks(self._store.get_name(name, encoding))
+        return iter([self._snapshots.get(exposition_format, b"")])
+
+    def get_encoding(
+        self, encoding: Optional[str], exposition_format: str = "text"
+    ) -> Optional[str]:
+        """
+        Returns given encoding when a snapshot compressed with it exists, or None to serve plain data
+        Until first collection there's nothing stored, and an empty body can't be sent as compressed
+        """
+        if not encoding or encoding not in self.encodings:
+            return None
+        name = self._store.get_name(
+            EXPOSITION_FORMATS[exposition_format]["file"], encoding
+        )
+        return encoding if self._store.exists(name) else None
+
+    def get_host_interval(self, host_config: dict) -> float:
+        """
+        Hosts may override the default collection interval
+        """
+        try:
+            return float(host_config["interval"])
+        except (AttributeError, ValueError, TypeError, KeyError):
+            return self.interval
+
+    def update_hosts(self, host_configs: List[dict]) -> None:
+        """
+        Replaces collected hosts, keeping results of hosts that are still configured
+        Hosts whose config changed are collected again right away
+        """
+        with self._lock:
+            previous = {
+                get_host_label(host_config): host_config
+                for host_config in self.host_configs
+            }
+            self.host_configs = list(host_configs)
+            hosts = [get_host_label(host_config) for host_config in self.host_configs]
+            for host in list(self._next_run):
+                if host not in hosts:
+                    self._next_run.pop(host)
+                    self._results.pop(host, None)
+            for host, host_config in zip(hosts, self.host_configs):
+                if previous.get(host) != host_config:
+                    self._next_run[host] = 0
+            # Followers have no results, rendering would replace the leader's shared snapshot
+            if self._leader is None or self._leader.acquired:
+                self._render()
+        self._wakeup.set()
+        logger.info(f"Background collection updated to {len(hosts)} hosts")
+
+    def start(self) -> None:
+        if self._thread:
+            return
+        self._stop.clear()
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.max_concurrency, thread_name_prefix="nakivo_collect"
+        )
+        self._thread = threading.Thread(
+            target=self._loop, name="nakivo_collector", daemon=True
+        )
+        self._thread.start()
+        logger.info(f"Background collection started for {len(self.host_configs)} hosts")
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        if self._executor:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+        if self._leader:
+            self._leader.release()
+
+    def _loop(self) -> None:
+        if self._leader:
+            while not self._leader.acquire():
+                if self._stop.wait(LEADER_RETRY_INTERVAL):
+                    return
+            logger.info("This worker is now collecting Nakivo data")
+            self._hold_render = self._store.exists(EXPOSITION_FORMATS["text"]["file"])
+        while not self._stop.is_set():
+            now = time.monotonic()
+            wake_times = []
+            with self._lock:
+                for host_config in self.host_configs:
+                    host = get_host_label(host_config)
+                    if host in self._started:
+                        # Collection is still running, report host as down once its deadline passed
+                        deadline = self._started[host] + self.host_timeout
+                        if now >= deadline:
+                            if self._results.get(host, {}).get("up") != 0:
+                                logger.error(
+                                    f"Collecting {host} did not finish within {self.host_timeout}s"
+                                )
+                                self._set_result(host, None, now - self._started[host])
+                                self._render()
+                        else:
+                            wake_times.append(deadline)
+                        continue
+                    if now >= self._next_run[host]:
+                        self._started[host] = now
+                        self._executor.submit(self._collect, host_config)
+                        wake_times.append(now + self.host_timeout)
+                    else:
+                        wake_times.append(self._next_run[host])
+            timeout = max(min(wake_times) - now, 0.1) if wake_times else None
+            self._wakeup.wait(timeout)
+            self._wakeup.clear()
+
+    def _collect(self, host_config: dict) -> None:
+        host = get_host_label(host_config)
+        start = time.monotonic()
+        try:
+            data = get_nakivo_data(host_config)
+        except Exception as exc:
+            logger.error(f"Collecting {host} failed: {exc}")
+            logger.debug("Trace", exc_info=True)
+            data = None
+        duration = time.monotonic() - start
+        if duration > self.host_timeout:
+            # Host has already been reported as down, discard late data
+            data = None
+        self_metrics.observe_collection(host, duration, not data)
+
+        with self._lock:
+            if self._stop.is_set():
+                # We may not be the leader anymore, don't overwrite the shared snapshot
+                return
+            self._started.pop(host, None)
+            if host not in self._next_run:
+                # Host has been removed from configuration meanwhile
+                return
+            self._set_result(host, data, duration)
+            self._next_run[host] = max(
+                start + self.get_host_interval(host_config), time.monotonic()
+            )
+            self._render()
+        self._wakeup.set()
+
+    def _set_result(
+        self, host: str, data: Optional[MetricSet], duration: float
+    ) -> None:
+        self._results[host] = {
+            "up": 1 if data else 0,
+            # Keep serving last known good data of a failing host instead of dropping its series
+            "data": data if data else get_stale_data(host),
+            "timestamp": time.time(),
+            "duration": duration,
+        }
+
+    def _render(self) -> None:
+        """
+        Renders prometheus data from all collected hosts, needs to be called with lock held
+        """
+        if self._hold_render:
+            if len(self._results) < len(self._next_run):
+                return
+            self._hold_render = False
+        hosts = [
+            get_host_label(host_config)
+            for host_config in self.host_configs
+            if get_host_label(host_config) in self._results
+        ]
+        status = MetricSet()
+        for host in hosts:
+            labels = (("host", host),)
+            result = self._results[host]
+            add_host_status(status, host, result["up"])
+            status.add(
+                "nakivo_last_scrape_timestamp_seconds",
+                "When was the Nakivo host last collected",
+                labels,
+                round(result["timestamp"], 3),
+            )
+            status.add(
+                "nakivo_scrape_duration_seconds",
+                "How long did the last Nakivo host collection take",
+                labels,
+                round(result["duration"], 3),
+            )
+        metric_sets = [status] + [self._results[host]["data"] for host in hosts]
+        if self_metrics.enabled:
+            metric_sets.append(self_metrics.collect())
+        for exposition_format in self.formats:
+            start = time.monotonic()
+            name = EXPOSITION_FORMATS[exposition_format]["file"]
+            if self.streaming:
+                # Write families to the store as they're rendered instead of building the whole payload
+                self._store.write_chunks(
+                    iter_format(metric_sets, exposition_format, self._render_cache),
+                    name,
+                )
+            else:
+                data = b"".join(
+                    iter_format(metric_sets, exposition_format, self._render_cache)
+                )
+                self._snapshots[exposition_format] = data
+                if self._store:
+                    self._store.write(data, name)
+            for encoding in self.encodings:
+                self._store.compress(encoding, name)
+            self_metrics.observe_render(exposition_format, time.monotonic() - start)
+        hits, misses = self._render_cache.rotate()
+        self_metrics.cache_access("render", hits, misses)
@@ -0,0 +1,121 @@
+#! /usr/bin/env python
+#  -*- coding: utf-8 -*-
+#
+# This file is part of nakivo_prometheus_exporter
+
+__appname__ = "nakivo_prometheus_exporter"
+__author__ = "Orsiris de Jong"
+__site__ = "https://www.github.com/netinvent/nakivo_prometheus_exporter"
+__description__ = "Naviko API Prometheus data exporter"
+__copyright__ = "Copyright (C) 2024 NetInvent"
+__license__ = "GPL-3.0-only"
+__build__ = "2026101701"
+
+
+import zlib
+from typing import BinaryIO, Iterable, Iterator, List, Optional, Union
+
+try:
+    import zstandard
+except ImportError:
+    # zstd is optional, gzip is always available
+    zstandard = None
+
+
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+COPY_CHUNK_SIZE = 65536
+
+# File name suffixes used when storing compressed snapshots
+ENCODING_SUFFIXES = {"gzip": "gz", "zstd": "zst"}
+
+
+def get_available_encodings() -> List[str]:
+    """
+    Returns supported content encodings, by order of preference
+    """
+    if zstandard:
+        return ["zstd", "gzip"]
+    return ["gzip"]
+
+
+def negotiate_encoding(accept_encoding: str, available: List[str]) -> Optional[str]:
+    """
+    Picks the best encoding from an Accept-Encoding header, honoring q-values
+    On equal q-values, the order of available encodings wins
+    Returns None when the response should not be compressed
+    """
+    if not accept_encoding or not available:
+        return None
+    best = None
+    best_q = 0.0
+    for part in accept_encoding.split(","):
+        token, _, params = part.partition(";")
+        token = token.strip().lower()
+        q = 1.0
+        for param in params.split(";"):
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if q <= 0:
+            continue
+        candidates = available if token == "*" else [token]
+        for encoding in candidates:
+            if encoding not in available:
+                continue
+            if (
+                best is None
+                or q > best_q
+                or (q == best_q and available.index(encoding) < available.index(best))
+            ):
+                best = encoding
+                best_q = q
+    return best
+
+
+def _new_compressor(encoding: str):
+    if encoding == "gzip":
+        # wbits 31 produces a gzip container
+        return zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+    if encoding == "zstd" and zstandard:
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+    raise ValueError(f"Unsupported encoding {encoding}")
+
+
+def compress(data: Union[str, bytes], encoding: str) -> bytes:
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    compressor = _new_compressor(encoding)
+    return compressor.compress(data) + compressor.flush()
+
+
+def iter_compressed(
+    chunks: Iterable[Union[str, bytes]], encoding: str
+) -> Iterator[bytes]:
+    """
+    Compresses a stream of chunks without holding the whole payload
+    """
+    compressor = _new_compressor(encoding)
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode("utf-8")
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def compress_file(source: BinaryIO, destination: BinaryIO, encoding: str) -> None:
+    """
+    Compresses a file object into another one chunk by chunk
+    """
+    compressor = _new_compressor(encoding)
+    while True:
+        chunk = source.read(COPY_CHUNK_SIZE)
+        if not chunk:
+            break
+        destination.write(compressor.compress(chunk))
+    destination.write(compressor.flush())
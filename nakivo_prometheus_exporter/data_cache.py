@@ -0,0 +1,124 @@
+#! /usr/bin/env python
+#  -*- coding: utf-8 -*-
+#
+# This file is part of nakivo_prometheus_exporter
+
+__appname__ = "nakivo_prometheus_exporter"
+__author__ = "Orsiris de Jong"
+__site__ = "https://www.github.com/netinvent/nakivo_prometheus_exporter"
+__description__ = "Naviko API Prometheus data exporter"
+__copyright__ = "Copyright (C) 2024 NetInvent"
+__license__ = "GPL-3.0-only"
+__build__ = "2026101701"
+
+
+import time
+import threading
+from typing import Optional, Tuple
+from nakivo_prometheus_exporter.exposition import MetricSet
+
+# How long (seconds) last known good data of a host may be served when collecting it fails
+DEFAULT_MAX_STALENESS = 3600
+
+DATA_AGE_METRIC = "nakivo_data_age_seconds"
+DATA_AGE_DOCUMENTATION = "How old was the data when it was collected (seconds)"
+
+
+def get_max_staleness(config: dict) -> float:
+    """
+    Returns how long last known good data may be served, 0 disables serving stale data
+    """
+    try:
+        return float(config["collector"]["max_staleness"])
+    except (AttributeError, ValueError, TypeError, KeyError):
+        return DEFAULT_MAX_STALENESS
+
+
+class DataCache:
+    """
+    Thread safe store of the last successfully collected metrics per host and data type (license, jobs...)
+    so a transient Nakivo error doesn't leave gaps in the series
+    """
+
+    def __init__(self, max_staleness: float = DEFAULT_MAX_STALENESS):
+        self.max_staleness = max_staleness
+        # (host, data type): (metrics, collection time)
+        self._entries = {}
+        # host: API error series of the last collection attempt
+        self._errors = {}
+        self._lock = threading.Lock()
+
+    def store(self, host: str, data: str, metrics: MetricSet) -> None:
+        with self._lock:
+            self._entries[(host, data)] = (metrics, time.time())
+
+    def store_errors(self, host: str, metrics: MetricSet) -> None:
+        """
+        Remembers API error series of a collection attempt, served with last known good data
+        until the next attempt, so they don't vanish while the host is down or skipped
+        """
+        with self._lock:
+            self._errors[host] = metrics
+
+    def get(
+        self, host: str, data: str, max_age: Optional[float] = None
+    ) -> Optional[Tuple[MetricSet, float]]:
+        """
+        Returns last known good metrics of given data type and their age, or None when there are none fresh enough
+        max_age defaults to max_staleness
+        """
+        if max_age is None:
+            max_age = self.max_staleness
+        with self._lock:
+            try:
+                metrics, timestamp = self._entries[(host, data)]
+            except KeyError:
+                return None
+            age = time.time() - timestamp
+            if age > self.max_staleness:
+                del self._entries[(host, data)]
+                return None
+            if age > max_age:
+                return None
+            return metrics, age
+
+    def get_host(self, host: str) -> MetricSet:
+        """
+        Returns every last known good data type of given host along with its age,
+        and API errors of its last collection attempt
+        """
+        with self._lock:
+            data_types = [
+                data for entry_host, data in self._entries if entry_host == host
+            ]
+            errors = self._errors.get(host)
+        metrics = MetricSet()
+        if errors:
+            metrics.update(errors)
+        for data in data_types:
+            cached = self.get(host, data)
+            if cached:
+                add_data(metrics, host, data, *cached)
+        return metrics
+
+    def remove(self, host: str) -> None:
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == host]:
+                del self._entries[key]
+            self._errors.pop(host, None)
+
+
+def add_data(
+    metrics: MetricSet, host: str, data: str, fragment: MetricSet, age: float
+) -> MetricSet:
+    """
+    Adds metrics of a data type to the host metrics, along with how old they are
+    """
+    metrics.update(fragment)
+    metrics.add(
+        DATA_AGE_METRIC,
+        DATA_AGE_DOCUMENTATION,
+        (("host", host), ("data", data)),
+        round(age),
+    )
+    return metrics
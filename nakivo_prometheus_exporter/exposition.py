@@ -0,0 +1,583 @@
+#! /usr/bin/env python
+#  -*- coding: utf-8 -*-
+#
+# This file is part of nakivo_prometheus_exporter
+
+__appname__ = "nakivo_prometheus_exporter"
+__author__ = "Orsiris de Jong"
+__site__ = "https://www.github.com/netinvent/nakivo_prometheus_exporter"
+__description__ = "Naviko API Prometheus data exporter"
+__copyright__ = "Copyright (C) 2024 NetInvent"
+__license__ = "GPL-3.0-only"
+__build__ = "2026101701"
+
+
+import struct
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple, Union
+
+
+# Labels are stored as tuples of (label_name, label_value) pairs
+Labels = Tuple[Tuple[str, str], ...]
+
+TEXT_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+OPENMETRICS_CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+PROTOBUF_CONTENT_TYPE = "application/vnd.google.protobuf; proto=io.prometheus.client.MetricFamily; encoding=delimited"
+
+# Family fingerprints are sums of sample hashes, kept to 64 bits
+FINGERPRINT_MASK = (1 << 64) - 1
+
+# io.prometheus.client.MetricType enum values
+PROTOBUF_METRIC_TYPES = {
+    "counter": 0,
+    "gauge": 1,
+    "summary": 2,
+    "untyped": 3,
+    "histogram": 4,
+}
+# io.prometheus.client.Metric field holding the value of each metric type
+PROTOBUF_VALUE_FIELDS = {"gauge": 2, "counter": 3, "untyped": 5}
+
+
+class Sample:
+    """
+    A single prometheus value with its labels
+    """
+
+    __slots__ = ("labels", "value", "timestamp")
+
+    def __init__(
+        self,
+        labels: Labels,
+        value: Union[int, float],
+        timestamp: Optional[float] = None,
+    ):
+        self.labels = labels
+        self.value = value
+        self.timestamp = timestamp
+
+
+class HistogramValue:
+    """
+    Value of a histogram sample: cumulative counts per bucket upper bound, sum and count of observations
+    """
+
+    __slots__ = ("buckets", "sum", "count")
+
+    def __init__(
+        self,
+        buckets: Tuple[Tuple[float, int], ...],
+        total: float,
+        count: int,
+    ):
+        self.buckets = buckets
+        self.sum = total
+        self.count = count
+
+
+class MetricFamily:
+    """
+    All samples sharing a metric name, rendered under a single HELP / TYPE block
+    """
+
+    __slots__ = ("name", "documentation", "type", "samples", "_fingerprint")
+
+    def __init__(self, name: str, documentation: str, metric_type: str = "gauge"):
+        self.name = name
+        self.documentation = documentation
+        self.type = metric_type
+        self.samples = []
+        self._fingerprint = None
+
+    def fingerprint(self) -> tuple:
+        """
+        Returns a key equal for families holding the same samples, whatever their order,
+        since concurrently collected chunks don't always complete in the same order
+        Families are only appended to once collected, so the key is kept until samples are added
+        """
+        count = len(self.samples)
+        if self._fingerprint is None or self._fingerprint[0] != count:
+            self._fingerprint = (
+                count,
+                sum(
+                    hash((sample.labels, sample.value, sample.timestamp))
+                    for sample in self.samples
+                )
+                & FINGERPRINT_MASK,
+            )
+        return self._fingerprint
+
+
+class MetricSet:
+    """
+    Ordered collection of metric families, one family per metric name
+    """
+
+    __slots__ = ("families",)
+
+    def __init__(self):
+        self.families = {}
+
+    def __bool__(self) -> bool:
+        return bool(self.families)
+
+    def family(
+        self, name: str, documentation: str, metric_type: str = "gauge"
+    ) -> MetricFamily:
+        """
+        Returns the family for given name, creating it if needed
+        """
+        try:
+            return self.families[name]
+        except KeyError:
+            family = MetricFamily(name, documentation, metric_type)
+            self.families[name] = family
+            return family
+
+    def add(
+        self,
+        name: str,
+        documentation: str,
+        labels: Labels,
+        value: Union[int, float],
+        metric_type: str = "gauge",
+        timestamp: Optional[float] = None,
+    ) -> None:
+        self.family(name, documentation, metric_type).samples.append(
+            Sample(labels, value, timestamp)
+        )
+
+    def update(self, other: "MetricSet") -> "MetricSet":
+        """
+        Appends samples of another metric set, family by family
+        """
+        for name, family in other.families.items():
+            self.family(name, family.documentation, family.type).samples.extend(
+                family.samples
+            )
+        return self
+
+
+class RenderCache:
+    """
+    Rendered samples of metric families, reused as long as a family holds the same samples
+    so unchanged hosts aren't formatted again on every render
+    Entries not used by the last render are dropped on rotate()
+
+    Formatted label sets are kept the same way, since every object's label set is shared
+    by several families and stays the same across collections, so the cache grows with
+    the estate instead of thrashing once it outgrows a fixed size
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._used = {}
+        self._labels = {}
+        self._previous_labels = {}
+        self.hits = 0
+        self.misses = 0
+
+    def format_labels(self, labels: Labels) -> str:
+        try:
+            return self._labels[labels]
+        except KeyError:
+            pass
+        try:
+            formatted = self._previous_labels[labels]
+        except KeyError:
+            formatted = format_labels(labels)
+        self._labels[labels] = formatted
+        return formatted
+
+    def get(
+        self,
+        exposition_format: str,
+        name: str,
+        metric_type: str,
+        family: MetricFamily,
+        render: Callable[..., Union[str, bytes]],
+    ) -> Union[str, bytes]:
+        key = (exposition_format, name, metric_type, family.fingerprint())
+        try:
+            chunk = self._entries[key]
+            self.hits += 1
+        except KeyError:
+            chunk = render(name, metric_type, family, self.format_labels)
+            self.misses += 1
+        self._used[key] = chunk
+        return chunk
+
+    def rotate(self) -> Tuple[int, int]:
+        """
+        Forgets families and label sets that weren't rendered since last rotation
+        Returns hits and misses since last rotation
+        """
+        self._entries = self._used
+        self._used = {}
+        self._previous_labels = self._labels
+        self._labels = {}
+        hits, misses = self.hits, self.misses
+        self.hits = self.misses = 0
+        return hits, misses
+
+
+def format_value(value: Union[int, float, bool, None]) -> str:
+    if value is None:
+        return "NaN"
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    if isinstance(value, int):
+        return str(value)
+    if value != value:  # pylint: disable=comparison-with-itself (NaN check)
+        return "NaN"
+    if value in (float("inf"), float("-inf")):
+        return "+Inf" if value > 0 else "-Inf"
+    if value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def escape_label_value(value) -> str:
+    """
+    Escapes backslashes, double quotes and line feeds, which would otherwise break parsing of the whole scrape
+    """
+    value = str(value)
+    if "\\" in value or '"' in value or "\n" in value:
+        return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return value
+
+
+def format_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    return (
+        "{"
+        + ",".join(f'{name}="{escape_label_value(value)}"' for name, value in labels)
+        + "}"
+    )
+
+
+def iter_histogram_series(
+    name: str, labels: Labels, value: HistogramValue
+) -> Iterator[Tuple[str, Labels, Union[int, float]]]:
+    """
+    Expands a histogram sample into its _bucket, _sum and _count series
+    """
+    for upper_bound, count in value.buckets:
+        yield f"{name}_bucket", labels + (("le", format_value(upper_bound)),), count
+    yield f"{name}_bucket", labels + (("le", "+Inf"),), value.count
+    yield f"{name}_sum", labels, value.sum
+    yield f"{name}_count", labels, value.count
+
+
+def merge_families(metric_sets: Iterable[MetricSet]) -> dict:
+    """
+    Groups families of multiple metric sets by name, keeping first seen order
+    Returns a dict of name: (first family, [families])
+    """
+    merged = {}
+    for metric_set in metric_sets:
+        if not metric_set:
+            continue
+        for name, family in metric_set.families.items():
+            try:
+                merged[name][1].append(family)
+            except KeyError:
+                merged[name] = (family, [family])
+    return merged
+
+
+def _text_samples(
+    name: str,
+    metric_type: str,
+    family: MetricFamily,
+    labels_formatter: Callable[[Labels], str] = format_labels,
+) -> str:
+    # Sample timestamps are only exposed in OpenMetrics and protobuf formats, so clients
+    # that don't ask for them never get samples Prometheus would reject as too old
+    lines = []
+    for sample in family.samples:
+        if metric_type == "histogram":
+            lines += [
+                f"{series}{labels_formatter(labels)} {format_value(value)}\n"
+                for series, labels, value in iter_histogram_series(
+                    name, sample.labels, sample.value
+                )
+            ]
+            continue
+        lines.append(
+            f"{name}{labels_formatter(sample.labels)} {format_value(sample.value)}\n"
+        )
+    return "".join(lines)
+
+
+def _render_samples(
+    exposition_format: str,
+    render: Callable[..., Union[str, bytes]],
+    name: str,
+    metric_type: str,
+    family: MetricFamily,
+    cache: Optional[RenderCache],
+) -> Union[str, bytes]:
+    if cache is None:
+        return render(name, metric_type, family)
+    return cache.get(exposition_format, name, metric_type, family, render)
+
+
+def iter_text(
+    metric_sets: Iterable[MetricSet], cache: Optional[RenderCache] = None
+) -> Iterator[str]:
+    """
+    Renders metric sets in prometheus text exposition format, yielding one chunk per metric family
+    Families with the same name coming from different sets (eg hosts) share a single HELP / TYPE block
+    """
+    for name, (header, families) in merge_families(metric_sets).items():
+        lines = [
+            f"# HELP {name} {header.documentation}\n",
+            f"# TYPE {name} {header.type}\n",
+        ]
+        for family in families:
+            lines.append(
+                _render_samples("text", _text_samples, name, header.type, family, cache)
+            )
+        yield "".join(lines)
+
+
+def render_text(metric_sets: Iterable[MetricSet]) -> str:
+    """
+    Renders metric sets in prometheus text exposition format
+    """
+    return "".join(iter_text(metric_sets))
+
+
+def _openmetrics_samples(
+    name: str,
+    metric_type: str,
+    family: MetricFamily,
+    labels_formatter: Callable[[Labels], str] = format_labels,
+) -> str:
+    lines = []
+    for sample in family.samples:
+        if metric_type == "histogram":
+            lines += [
+                f"{series}{labels_formatter(labels)} {format_value(value)}\n"
+                for series, labels, value in iter_histogram_series(
+                    name, sample.labels, sample.value
+                )
+            ]
+        elif sample.timestamp is None:
+            lines.append(
+                f"{name}{labels_formatter(sample.labels)} {format_value(sample.value)}\n"
+            )
+        else:
+            # OpenMetrics timestamps are seconds
+            lines.append(
+                f"{name}{labels_formatter(sample.labels)} {format_value(sample.value)} {format_value(sample.timestamp)}\n"
+            )
+    return "".join(lines)
+
+
+def iter_openmetrics(
+    metric_sets: Iterable[MetricSet], cache: Optional[RenderCache] = None
+) -> Iterator[str]:
+    """
+    Renders metric sets in OpenMetrics text format, yielding one chunk per metric family
+    """
+    for name, (header, families) in merge_families(metric_sets).items():
+        # OpenMetrics counter families are named without their _total suffix
+        family_name = name
+        if header.type == "counter" and name.endswith("_total"):
+            family_name = name[: -len("_total")]
+        lines = [
+            f"# TYPE {family_name} {header.type}\n",
+            f"# HELP {family_name} {header.documentation}\n",
+        ]
+        for family in families:
+            lines.append(
+                _render_samples(
+                    "openmetrics",
+                    _openmetrics_samples,
+                    name,
+                    header.type,
+                    family,
+                    cache,
+                )
+            )
+        yield "".join(lines)
+    yield "# EOF\n"
+
+
+def _varint(value: int) -> bytes:
+    if value < 0:
+        # int64 negative values are encoded as 10 bytes two's complement
+        value += 1 << 64
+    data = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            data.append(byte | 0x80)
+        else:
+            data.append(byte)
+            return bytes(data)
+
+
+def _field_bytes(number: int, data: bytes) -> bytes:
+    return _varint(number << 3 | 2) + _varint(len(data)) + data
+
+
+def _field_string(number: int, value: str) -> bytes:
+    return _field_bytes(number, value.encode("utf-8"))
+
+
+def _field_varint(number: int, value: int) -> bytes:
+    return _varint(number << 3) + _varint(value)
+
+
+def _field_double(number: int, value: float) -> bytes:
+    return _varint(number << 3 | 1) + struct.pack("<d", value)
+
+
+def _histogram_bytes(value: HistogramValue) -> bytes:
+    # io.prometheus.client.Histogram: sample_count, sample_sum, buckets
+    data = [_field_varint(1, value.count), _field_double(2, float(value.sum))]
+    for upper_bound, count in value.buckets:
+        data.append(
+            _field_bytes(
+                3, _field_varint(1, count) + _field_double(2, float(upper_bound))
+            )
+        )
+    return b"".join(data)
+
+
+def _protobuf_samples(
+    name: str,
+    metric_type: str,
+    family: MetricFamily,
+    labels_formatter: Callable[[Labels], str] = format_labels,
+) -> bytes:
+    # Returns encoded io.prometheus.client.Metric messages, as MetricFamily metric fields
+    # Protobuf label values are sent raw, labels_formatter is only there for a common signature
+    histogram = metric_type == "histogram"
+    value_field = PROTOBUF_VALUE_FIELDS.get(
+        metric_type, PROTOBUF_VALUE_FIELDS["untyped"]
+    )
+    data = []
+    for sample in family.samples:
+        metric = [
+            _field_bytes(
+                1,
+                _field_string(1, label_name) + _field_string(2, str(label_value)),
+            )
+            for label_name, label_value in sample.labels
+        ]
+        if histogram:
+            metric.append(_field_bytes(7, _histogram_bytes(sample.value)))
+        else:
+            value = float("nan") if sample.value is None else float(sample.value)
+            metric.append(_field_bytes(value_field, _field_double(1, value)))
+        if sample.timestamp is not None:
+            metric.append(_field_varint(6, int(sample.timestamp * 1000)))
+        data.append(_field_bytes(4, b"".join(metric)))
+    return b"".join(data)
+
+
+def iter_protobuf(
+    metric_sets: Iterable[MetricSet], cache: Optional[RenderCache] = None
+) -> Iterator[bytes]:
+    """
+    Renders metric sets as length delimited io.prometheus.client.MetricFamily protobuf messages
+    """
+    for name, (header, families) in merge_families(metric_sets).items():
+        metric_type = header.type if header.type in PROTOBUF_VALUE_FIELDS else "untyped"
+        if header.type == "histogram":
+            metric_type = "histogram"
+        message = [
+            _field_string(1, name),
+            _field_string(2, header.documentation),
+            _field_varint(3, PROTOBUF_METRIC_TYPES[metric_type]),
+        ]
+        for family in families:
+            message.append(
+                _render_samples(
+                    "protobuf", _protobuf_samples, name, header.type, family, cache
+                )
+            )
+        message = b"".join(message)
+        yield _varint(len(message)) + message
+
+
+# Exposition format name: content type, renderer, snapshot file name
+EXPOSITION_FORMATS = {
+    "text": {
+        "content_type": TEXT_CONTENT_TYPE,
+        "render": iter_text,
+        "file": "metrics.prom",
+    },
+    "openmetrics": {
+        "content_type": OPENMETRICS_CONTENT_TYPE,
+        "render": iter_openmetrics,
+        "file": "metrics.om",
+    },
+    "protobuf": {
+        "content_type": PROTOBUF_CONTENT_TYPE,
+        "render": iter_protobuf,
+        "file": "metrics.pb",
+    },
+}
+
+
+def _get_media_format(media_type: str, params: dict) -> Optional[str]:
+    if media_type == "application/vnd.google.protobuf":
+        if (
+            params.get("proto") == "io.prometheus.client.MetricFamily"
+            and params.get("encoding") == "delimited"
+        ):
+            return "protobuf"
+        return None
+    if media_type == "application/openmetrics-text":
+        return "openmetrics"
+    if media_type in ("text/plain", "text/*", "*/*"):
+        return "text"
+    return None
+
+
+def negotiate_format(accept: Optional[str], available: List[str]) -> str:
+    """
+    Picks the best exposition format from an Accept header, honoring q-values
+    Falls back to prometheus text format, which every scraper understands
+    """
+    best = "text"
+    best_q = 0.0
+    if not accept:
+        return best
+    for part in accept.split(","):
+        media_type, *raw_params = part.split(";")
+        params = {}
+        for param in raw_params:
+            key, _, value = param.partition("=")
+            params[key.strip().lower()] = value.strip().strip('"')
+        try:
+            q = float(params.get("q", 1))
+        except ValueError:
+            q = 0.0
+        exposition_format = _get_media_format(media_type.strip().lower(), params)
+        if not exposition_format or exposition_format not in available:
+            continue
+        if q > best_q:
+            best = exposition_format
+            best_q = q
+    return best
+
+
+def iter_format(
+    metric_sets: Iterable[MetricSet],
+    exposition_format: str = "text",
+    cache: Optional[RenderCache] = None,
+) -> Iterator[bytes]:
+    """
+    Renders metric sets in given exposition format as bytes chunks
+    """
+    for chunk in EXPOSITION_FORMATS[exposition_format]["render"](metric_sets, cache):
+        if isinstance(chunk, str):
+            chunk = chunk.encode("utf-8")
+        yield chunk
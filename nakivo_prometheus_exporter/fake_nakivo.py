@@ -0,0 +1,243 @@
+#! /usr/bin/env python
+#  -*- coding: utf-8 -*-
+#
+# This file is part of nakivo_prometheus_exporter
+
+__appname__ = "nakivo_prometheus_exporter"
+__author__ = "Orsiris de Jong"
+__site__ = "https://www.github.com/netinvent/nakivo_prometheus_exporter"
+__description__ = "Naviko API Prometheus data exporter"
+__copyright__ = "Copyright (C) 2024 NetInvent"
+__license__ = "GPL-3.0-only"
+__build__ = "2026101701"
+
+
+import json
+import secrets
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+SESSION_COOKIE = "JSESSIONID"
+# lrState of generated objects, picked in turn
+OBJECT_STATES = ("SUCCEEDED",) * 8 + ("FAILED", None)
+# status of generated jobs, picked in turn
+JOB_STATUSES = ("GREEN",) * 8 + ("YELLOW", "RED")
+
+
+class FakeNakivo:
+    """
+    Stand-in Nakivo director answering c/router calls with synthetic data of configurable size
+    Every call waits for latency seconds before answering, to mimic a remote director
+    """
+
+    def __init__(
+        self,
+        jobs: int = 10,
+        objects: int = 10,
+        latency: float = 0,
+        host: str = "127.0.0.1",
+        port: int = 0,
+    ):
+        self.jobs = jobs
+        self.objects = objects
+        self.latency = latency
+        self.sessions = set()
+        self.calls = {}
+        self.requests = 0
+        # Answer batched transactions, like Nakivo router does
+        self.batching = True
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._get_handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "FakeNakivo":
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, name="fake_nakivo", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def expire_sessions(self) -> None:
+        with self._lock:
+            self.sessions.clear()
+
+    def license_info(self) -> dict:
+        return {
+            "installed": True,
+            "client": "Benchmark",
+            "usedVms": self.jobs * self.objects,
+            "usedSockets": 4,
+            "expiresIn": 86400 * 365 * 1000,
+        }
+
+    def group_info(self) -> dict:
+        return {
+            "children": [
+                {
+                    "id": 1,
+                    "name": "Benchmark",
+                    "childJobIds": list(range(self.jobs)),
+                    "children": [
+                        {
+                            "id": job_id,
+                            "name": f"Job {job_id}",
+                            "status": JOB_STATUSES[job_id % len(JOB_STATUSES)],
+                            "lrFinishDate": 1700000000000 + job_id * 1000,
+                        }
+                        for job_id in range(self.jobs)
+                    ],
+                }
+            ]
+        }
+
+    def job_info(self, job_ids: list) -> dict:
+        return {
+            "children": [
+                {
+                    "id": job_id,
+                    "name": f"Job {job_id}",
+                    "status": JOB_STATUSES[job_id % len(JOB_STATUSES)],
+                    "nextRunDate": 1700086400000 + job_id * 1000,
+                    "objects": [
+                        {
+                            "sourceName": f"vm-{job_id}-{index}",
+                            "lrState": OBJECT_STATES[index % len(OBJECT_STATES)],
+                            "lrDuration": 60000 + index,
+                            "lrDataTransferredUncompressed": 1048576 * index,
+                            "lrFinishDate": 1700000000000 + job_id * 1000 + index,
+                            "lrSpeed": 17476 * index,
+                            "lastSuccessDate": 1700000000000 + job_id * 1000,
+                            "pointsCount": 7 + index % 24,
+                        }
+                        for index in range(self.objects)
+                    ],
+                }
+                for job_id in job_ids
+                if 0 <= job_id < self.jobs
+            ]
+        }
+
+    def repository_info(self, repository_id: int) -> dict:
+        size = 1099511627776 * repository_id
+        return {
+            "id": repository_id,
+            "name": f"Repository {repository_id}",
+            "state": "OK",
+            "size": size,
+            "freeSpace": size // 4,
+            "usedSpace": size - size // 4,
+            "dedupRatio": 2.5,
+        }
+
+    def answer(self, payload: dict, session: Optional[str]) -> tuple:
+        """
+        Returns the reply to a single RPC transaction, and a new session id when logging in
+        """
+        method = payload.get("method")
+        with self._lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+        reply = {
+            "action": payload.get("action"),
+            "method": method,
+            "tid": payload.get("tid"),
+            "type": "rpc",
+        }
+        new_session = None
+        if method == "login":
+            new_session = secrets.token_hex(16)
+            with self._lock:
+                self.sessions.add(new_session)
+            reply["data"] = {"id": 1}
+            return reply, new_session
+        with self._lock:
+            authenticated = session in self.sessions
+        if not authenticated:
+            reply["type"] = "exception"
+            reply["message"] = "Your session has expired, please login again"
+            return reply, None
+        if method == "logout":
+            with self._lock:
+                self.sessions.discard(session)
+            reply["data"] = None
+        elif method == "getLicenseInfo":
+            reply["data"] = self.license_info()
+        elif method == "getGroupInfo":
+            reply["data"] = self.group_info()
+        elif method == "getJobInfo":
+            reply["data"] = self.job_info(payload["data"][0])
+        elif method == "getBackupRepository":
+            reply["data"] = self.repository_info(payload["data"][0])
+        else:
+            reply["type"] = "exception"
+            reply["message"] = f"Unknown method {method}"
+        return reply, None
+
+    def _get_handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+                pass
+
+            def _send(self, body: bytes, cookie: Optional[str] = None) -> None:
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                if cookie:
+                    self.send_header("Set-Cookie", f"{SESSION_COOKIE}={cookie}; Path=/")
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                self._send(b"{}")
+
+            def do_POST(self):
+                if fake.latency:
+                    time.sleep(fake.latency)
+                payload = json.loads(
+                    self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                )
+                with fake._lock:
+                    fake.requests += 1
+                session = None
+                for cookie in self.headers.get("Cookie", "").split(";"):
+                    name, _, value = cookie.strip().partition("=")
+                    if name == SESSION_COOKIE:
+                        session = value
+                # Nakivo router accepts a single transaction, or a list of them
+                if isinstance(payload, list) and not fake.batching:
+                    reply, new_session = {
+                        "type": "exception",
+                        "message": "Batched transactions are not supported",
+                    }, None
+                elif isinstance(payload, list):
+                    replies = [
+                        fake.answer(transaction, session) for transaction in payload
+                    ]
+                    reply = [transaction_reply for transaction_reply, _ in replies]
+                    new_session = next(
+                        (new_session for _, new_session in replies if new_session),
+                        None,
+                    )
+                else:
+                    reply, new_session = fake.answer(payload, session)
+                self._send(json.dumps(reply).encode("utf-8"), new_session)
+
+        return Handler
@@ -9,18 +9,53 @@ __site__ = "https://www.github.com/netinvent/nakivo_prometheus_exporter"
 __description__ = "Naviko API Prometheus data exporter"
 __copyright__ = "Copyright (C) 2024 NetInvent"
 __license__ = "GPL-3.0-only"
-__build__ = "2024101001"
+__build__ = "2026101701"
 
 
+import os
 import sys
+import time
+import signal
+import asyncio
+import threading
 import logging
 import secrets
+from contextlib import asynccontextmanager
 from argparse import ArgumentParser
-from fastapi import FastAPI, HTTPException, Depends, status
-from fastapi.responses import PlainTextResponse
+from typing import Optional
+from fastapi import FastAPI, HTTPException, Depends, Request, status
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import PlainTextResponse, Response, StreamingResponse
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
 from fastapi_offline import FastAPIOffline
-from nakivo_prometheus_exporter.prom_parser import load_config_file, get_nakivo_data
+from nakivo_prometheus_exporter.prom_parser import (
+    load_config_file,
+    collect_nakivo_hosts,
+    find_host_config,
+    diff_host_configs,
+    get_collector_settings,
+    apply_collector_settings,
+    api_registry,
+    data_cache,
+)
+from nakivo_prometheus_exporter.collector import (
+    Collector,
+    get_background_collection,
+    get_collect_interval,
+)
+from nakivo_prometheus_exporter.shared_store import get_shared_store_dir
+from nakivo_prometheus_exporter.self_metrics import self_metrics
+from nakivo_prometheus_exporter.exposition import (
+    iter_format,
+    negotiate_format,
+    EXPOSITION_FORMATS,
+)
+from nakivo_prometheus_exporter.compression import (
+    compress,
+    iter_compressed,
+    get_available_encodings,
+    negotiate_encoding,
+)
 
 
 logger = logging.getLogger()
@@ -44,9 +79,149 @@ if args.config_file:
 else:
     logger.critical("No configuration file given. Exiting.")
     sys.exit(1)
+apply_collector_settings(config_dict)
+
+try:
+    streaming = config_dict["http_server"]["streaming"] is True
+except (KeyError, AttributeError, TypeError):
+    streaming = False
+
+try:
+    compression = config_dict["http_server"]["compression"] is not False
+except (KeyError, AttributeError, TypeError):
+    compression = True
+encodings = get_available_encodings() if compression else []
+
+try:
+    formats = [
+        exposition_format
+        for exposition_format in config_dict["http_server"]["formats"]
+        if exposition_format in EXPOSITION_FORMATS
+    ]
+    if "text" not in formats:
+        # Text format is our fallback when nothing else can be negotiated
+        formats.append("text")
+except (KeyError, AttributeError, TypeError):
+    # Every configured format is rendered on each collection, so only text is rendered by default
+    formats = ["text"]
+
+# Seconds kept from Prometheus scrape timeout to render and send a probe reply
+PROBE_TIMEOUT_MARGIN = 0.5
+
+collector = None
+if get_background_collection(config_dict):
+    try:
+        max_concurrency, host_timeout = get_collector_settings(config_dict)
+        collector = Collector(
+            config_dict["nakivo_hosts"],
+            max_concurrency,
+            host_timeout,
+            get_collect_interval(config_dict),
+            # gunicorn workers share a single collector
+            get_shared_store_dir(config_dict, args.config_file),
+            streaming,
+            encodings,
+            formats,
+        )
+    except KeyError:
+        logger.critical("Bogus configuration file. Missing nakivo_hosts key.")
+    except PermissionError as exc:
+        logger.critical(f"Cannot use shared store: {exc}")
+        sys.exit(1)
+
+
+# How often (seconds) the configuration file is checked for changes
+CONFIG_WATCH_INTERVAL = 10
+
+
+def get_config_mtime() -> Optional[float]:
+    try:
+        return os.stat(args.config_file).st_mtime
+    except OSError:
+        return None
+
+
+config_mtime = get_config_mtime()
+reload_lock = threading.Lock()
+
+
+def reload_config() -> dict:
+    """
+    Loads the configuration file again and applies nakivo_hosts changes
+    Sessions and cached data of unchanged hosts are kept, removed hosts are forgotten,
+    and hosts whose credentials changed get a new session
+    HTTP server settings still need a restart
+    """
+    with reload_lock:
+        return _reload_config()
 
 
-app = FastAPIOffline()
+def _reload_config() -> dict:
+    global config_dict, config_mtime  # pylint: disable=global-statement
+
+    config_mtime = get_config_mtime()
+    new_config = load_config_file(args.config_file)
+    try:
+        new_host_configs = list(new_config["nakivo_hosts"])
+    except (KeyError, AttributeError, TypeError):
+        logger.error("Not reloading bogus configuration file")
+        return {"reloaded": False}
+
+    changes = diff_host_configs(config_dict["nakivo_hosts"], new_host_configs)
+    for host in changes["removed"]:
+        api_registry.remove(host)
+        data_cache.remove(host)
+    for host in changes["reconnected"]:
+        api_registry.remove(host)
+    apply_collector_settings(new_config)
+    config_dict = new_config
+    if collector:
+        collector.host_timeout = get_collector_settings(config_dict)[1]
+        collector.interval = get_collect_interval(config_dict)
+        collector.update_hosts(new_host_configs)
+    logger.info(
+        f"Configuration reloaded, hosts added: {changes['added']}, removed: {changes['removed']}, changed: {changes['changed']}"
+    )
+    return {"reloaded": True, **changes}
+
+
+async def watch_config(reload_event: asyncio.Event) -> None:
+    """
+    Reloads configuration when its file changes, or when reload_event is set (eg on SIGHUP)
+    """
+    while True:
+        try:
+            await asyncio.wait_for(reload_event.wait(), CONFIG_WATCH_INTERVAL)
+        except asyncio.TimeoutError:
+            if get_config_mtime() == config_mtime:
+                continue
+        reload_event.clear()
+        try:
+            await run_in_threadpool(reload_config)
+        except Exception as exc:
+            logger.error(f"Cannot reload configuration: {exc}")
+            logger.debug("Trace", exc_info=True)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if collector:
+        collector.start()
+    reload_event = asyncio.Event()
+    try:
+        # SIGHUP has to be sent to worker processes, gunicorn's master restarts its workers on SIGHUP
+        asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, reload_event.set)
+    except (AttributeError, NotImplementedError, RuntimeError, ValueError):
+        # No SIGHUP on Windows, and signals can only be handled in main thread
+        pass
+    watcher = asyncio.create_task(watch_config(reload_event))
+    yield
+    watcher.cancel()
+    if collector:
+        collector.stop()
+
+
+app = FastAPIOffline(lifespan=lifespan)
 security = HTTPBasic()
 
 # Timestamp of last time we sent an sms, per number
@@ -94,14 +269,108 @@ async def api_root(auth=Depends(auth_scheme)):
     return {"app": __appname__}
 
 
+def metrics_response(
+    content, exposition_format: str, encoding: Optional[str], stream: bool = False
+):
+    headers = {"Vary": "Accept, Accept-Encoding"}
+    if encoding:
+        headers["Content-Encoding"] = encoding
+    media_type = EXPOSITION_FORMATS[exposition_format]["content_type"]
+    if stream:
+        return StreamingResponse(content, media_type=media_type, headers=headers)
+    return Response(content, media_type=media_type, headers=headers)
+
+
 @app.get("/metrics", response_class=PlainTextResponse)
-async def get_metrics(auth=Depends(auth_scheme)):
-    data = ""
+async def get_metrics(request: Request, auth=Depends(auth_scheme)):
+    exposition_format = negotiate_format(request.headers.get("accept"), formats)
+    encoding = negotiate_encoding(request.headers.get("accept-encoding"), encodings)
+    if collector:
+        # Formats and compressed snapshots are produced once per collection, not per request
+        encoding = collector.get_encoding(encoding, exposition_format)
+        if streaming:
+            return metrics_response(
+                collector.iter_snapshot(encoding, exposition_format),
+                exposition_format,
+                encoding,
+                stream=True,
+            )
+        return metrics_response(
+            collector.get_snapshot(encoding, exposition_format),
+            exposition_format,
+            encoding,
+        )
+    max_concurrency, host_timeout = get_collector_settings(config_dict)
     try:
-        for nakivo_host in config_dict["nakivo_hosts"]:
-            sub_data = get_nakivo_data(nakivo_host)
-            if sub_data:
-                data += sub_data
-        return data
+        # Nakivo API calls are blocking, run them in a worker thread so the event loop
+        # keeps serving other requests while we scrape
+        metric_sets = await run_in_threadpool(
+            collect_nakivo_hosts,
+            config_dict["nakivo_hosts"],
+            max_concurrency,
+            host_timeout,
+        )
     except KeyError:
         logger.critical("Bogus configuration file. Missing nakivo_hosts key.")
+        return None
+    return await render_response(metric_sets, exposition_format, encoding)
+
+
+async def render_response(metric_sets, exposition_format: str, encoding: Optional[str]):
+    """
+    Renders live collected metric sets, streamed or at once
+    """
+    chunks = iter_format(metric_sets, exposition_format)
+    if streaming:
+        # Send every metric family as soon as it's rendered
+        # Families are grouped across hosts, so rendering can only start once every host
+        # has been collected: time to first byte still follows the slowest host
+        if encoding:
+            chunks = iter_compressed(chunks, encoding)
+        return metrics_response(chunks, exposition_format, encoding, stream=True)
+    start = time.monotonic()
+    data = await run_in_threadpool(b"".join, chunks)
+    self_metrics.observe_render(exposition_format, time.monotonic() - start)
+    if encoding:
+        data = await run_in_threadpool(compress, data, encoding)
+    return metrics_response(data, exposition_format, encoding)
+
+
+@app.post("/-/reload")
+async def post_reload(auth=Depends(auth_scheme)):
+    """
+    Reloads configuration file in this worker, other workers follow when they notice the file changed
+    """
+    return await run_in_threadpool(reload_config)
+
+
+@app.get("/probe", response_class=PlainTextResponse)
+async def get_probe(request: Request, target: str, auth=Depends(auth_scheme)):
+    """
+    Scrapes a single Nakivo host, given by its name in nakivo_hosts or its host url,
+    so Prometheus can spread hosts across targets with their own scrape timeouts
+    """
+    try:
+        host_config = find_host_config(config_dict["nakivo_hosts"], target)
+    except (KeyError, AttributeError, TypeError):
+        host_config = None
+    if not host_config:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail=f"Unknown target {target}"
+        )
+    exposition_format = negotiate_format(request.headers.get("accept"), formats)
+    encoding = negotiate_encoding(request.headers.get("accept-encoding"), encodings)
+    host_timeout = get_collector_settings(config_dict)[1]
+    try:
+        # Answer before Prometheus gives up on the scrape
+        scrape_timeout = float(request.headers["x-prometheus-scrape-timeout-seconds"])
+        host_timeout = min(
+            host_timeout,
+            max(scrape_timeout - PROBE_TIMEOUT_MARGIN, PROBE_TIMEOUT_MARGIN),
+        )
+    except (KeyError, ValueError):
+        pass
+    metric_sets = await run_in_threadpool(
+        collect_nakivo_hosts, [host_config], 1, host_timeout, False
+    )
+    return await render_response(metric_sets, exposition_format, encoding)
@@ -9,14 +9,147 @@ __site__ = "https://www.github.com/netinvent/nakivo_prometheus_exporter"
 __description__ = "Naviko API Prometheus data exporter"
 __copyright__ = "Copyright (C) 2024 NetInvent"
 __license__ = "GPL-3.0-only"
-__build__ = "2024032601"
+__build__ = "2026101701"
 
-from typing import Union, List
+import time
+import json
+import threading
+import warnings
+import itertools
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Iterator, Union, List, Optional, Tuple
+import requests
+from requests.adapters import HTTPAdapter
 from ofunctions.requestor import Requestor
 from logging import getLogger
+from nakivo_prometheus_exporter.self_metrics import self_metrics
+
+try:
+    import ijson
+except ImportError:
+    # Streaming JSON parsing is optional, replies are parsed at once otherwise
+    ijson = None
 
 logger = getLogger()
 
+# Evict sessions that haven't been used for this long (seconds)
+DEFAULT_SESSION_IDLE_TIMEOUT = 7200
+# How long (seconds) a single HTTP call to Nakivo may take
+DEFAULT_REQUEST_TIMEOUT = 50
+# When fetching jobs incrementally, every job is fetched again after this many seconds
+DEFAULT_JOB_FULL_REFRESH_INTERVAL = 3600
+# How many job ids are asked for in a single getJobInfo call, 0 asks for all jobs at once
+DEFAULT_JOB_CHUNK_SIZE = 100
+# How many getJobInfo chunks are queried at the same time over a session
+DEFAULT_PARALLEL_REQUESTS = 4
+
+# Nakivo API exception messages telling our session isn't valid anymore
+SESSION_EXPIRED_MESSAGES = ("session has expired", "session is expired")
+
+
+# Consecutive failed collections after which a host is skipped, 0 disables the circuit breaker
+DEFAULT_BREAKER_FAILURES = 3
+# First and maximal cooldown (seconds) during which a failing host is skipped
+DEFAULT_BREAKER_BACKOFF = 30
+DEFAULT_BREAKER_MAX_BACKOFF = 900
+
+# RPC calls as (action, method, data), so they can be sent one by one or batched
+LICENSE_RPC = ("LicensingManagement", "getLicenseInfo", None)
+# data: [[Groups: int, or None for all groups], clientTimeOffsetToUtc: int, Get Children: bool]
+JOB_LIST_RPC = ("JobSummaryManagement", "getGroupInfo", [[None], 0, True])
+
+
+def get_repository_rpc(repository_id: int) -> tuple:
+    # data: [repository id: int]
+    return ("BackupManagement", "getBackupRepository", [repository_id])
+
+
+# Replies smaller than this (bytes) are parsed at once, larger ones are streamed
+STREAM_THRESHOLD = 65536
+# How often (seconds) a chunk query waiting for a free stream checks whether jobs are still wanted
+STREAM_SLOT_WAIT = 0.5
+
+
+class ReplayStream:
+    """
+    File like object returning already read bytes before reading the rest of a stream
+    """
+
+    def __init__(self, head: bytes, stream):
+        self._head = head
+        self._stream = stream
+
+    def read(self, size: int = -1) -> bytes:
+        if self._head:
+            if size is None or size < 0:
+                data = self._head + self._stream.read()
+                self._head = b""
+                return data
+            data = self._head[:size]
+            self._head = self._head[size:]
+            return data
+        return self._stream.read(size)
+
+
+def _iter_children(stream, on_close=None) -> Iterator:
+    try:
+        yield from ijson.items(stream, "data.children.item")
+    finally:
+        if on_close:
+            on_close()
+
+
+def _release_after(children: Iterator, release) -> Iterator:
+    try:
+        yield from children
+    finally:
+        release()
+
+
+def parse_streamed_reply(stream, on_close=None) -> Optional[dict]:
+    """
+    Parses a Nakivo RPC reply while it's being read
+
+    Small replies, which include every API error, are parsed at once
+    Larger ones are returned right away, with data.children being a generator that builds
+    one child at a time from the stream, so the whole reply is never held in memory
+    on_close is called once the stream has been consumed
+    """
+    head = b""
+    try:
+        while len(head) < STREAM_THRESHOLD:
+            data = stream.read(STREAM_THRESHOLD - len(head))
+            if not data:
+                break
+            head += data
+    except Exception:
+        if on_close:
+            on_close()
+        raise
+    if len(head) < STREAM_THRESHOLD:
+        if on_close:
+            on_close()
+        return json.loads(head)
+    return {
+        "type": "rpc",
+        "data": {"children": _iter_children(ReplayStream(head, stream), on_close)},
+    }
+
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    """
+    Applies a default timeout to every request, since requests waits forever by default
+    """
+
+    def __init__(self, timeout: float, *args, **kwargs):
+        self.timeout = timeout
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.timeout
+        return super().send(request, **kwargs)
+
 
 class NakivoAPI:
     """
@@ -24,7 +157,12 @@ class NakivoAPI:
     """
 
     def __init__(
-        self, host: str, username: str, password: str, cert_verify: bool = True
+        self,
+        host: str,
+        username: str,
+        password: str,
+        cert_verify: bool = True,
+        timeout: float = DEFAULT_REQUEST_TIMEOUT,
     ):
         if not host:
             msg = "No Nakvio host given"
@@ -42,24 +180,88 @@ class NakivoAPI:
         self.username = username
         self.password = password
         self.cert_verify = cert_verify
+        self.timeout = timeout
 
         self.req = Requestor(host, cert_verify=self.cert_verify)
-        if not self.req.create_session():
+        if not self.create_session():
             msg = f"Cannot create session to {self.host}"
             logger.critical(msg)
             raise ValueError(msg)
         self.req.endpoint = "c/router"
 
-    def authenticate(self):
-        payload = {
-            "action": "AuthenticationManagement",
-            "method": "login",
-            # data: username, password, remember_me bool
-            "data": [self.username, self.password, False],
+        self.authenticated = False
+        # A requests session isn't meant to be shared between concurrent scrapes
+        self.lock = threading.RLock()
+        # Parallel calls seeing the same expired session log in again only once
+        self._auth_lock = threading.Lock()
+        self._session_generation = 0
+
+        # Transaction ids, so replies of a batch can be told apart
+        self._tids = itertools.count(1)
+        # Cleared when the router doesn't answer batches with a list of replies,
+        # batches are tried again after next login in case that was a transient error
+        self.batching = True
+
+        # Incremental job fetching: job id: (change marker, job details)
+        self._job_cache = {}
+        self._last_full_job_refresh = 0
+
+    def create_session(self) -> bool:
+        """
+        Sets up the HTTP session used by our requestor
+        Requestor doesn't bound its calls, so we mount an adapter with a timeout
+        so a hung host can't block a collection thread forever
+        """
+        api_session = requests.Session()
+        adapter = TimeoutHTTPAdapter(self.timeout)
+        api_session.mount("http://", adapter)
+        api_session.mount("https://", adapter)
+        if not self.cert_verify:
+            warnings.filterwarnings("ignore", category=Warning)
+        try:
+            result = api_session.get(self.host, verify=self.cert_verify)
+        except requests.exceptions.RequestException as exc:
+            logger.error(f"Cannot reach {self.host}: {exc}")
+            logger.debug("Trace", exc_info=True)
+            return False
+        if result.status_code != 200:
+            logger.error(f"{self.host} replied with status code {result.status_code}")
+            return False
+        self.req.api_session = api_session
+        self.req.connected_server = self.host
+        return True
+
+    def set_timeout(self, timeout: float) -> None:
+        """
+        Changes the timeout of every HTTP call made from now on
+        """
+        self.timeout = timeout
+        try:
+            for adapter in self.req.api_session.adapters.values():
+                if isinstance(adapter, TimeoutHTTPAdapter):
+                    adapter.timeout = timeout
+        except AttributeError:
+            pass
+
+    def _payload(self, action: str, method: str, data=None) -> dict:
+        return {
+            "action": action,
+            "method": method,
+            "data": data,
             "type": "rpc",
-            "tid": 1,
+            "tid": next(self._tids),
         }
-        result = self.req.requestor(action="create", data=payload)
+
+    def authenticate(self):
+        # Every login replaces the session cookie of calls made with the previous one
+        self._session_generation += 1
+        # data: username, password, remember_me bool
+        payload = self._payload(
+            "AuthenticationManagement",
+            "login",
+            [self.username, self.password, False],
+        )
+        result = self._send(payload)
         if not result:
             msg = "Authentication Error"
             try:
@@ -68,61 +270,678 @@ class NakivoAPI:
             except AttributeError:
                 logger.error(": No more info. Error code")
                 return False
+        try:
+            if result["type"] == "exception":
+                # Bad credentials, don't consider ourselves logged in
+                logger.error(
+                    f"Authentication refused by {self.host}: {result['message']}"
+                )
+                return False
+        except (IndexError, KeyError, TypeError):
+            pass
+        self.authenticated = True
+        self.batching = True
+        return result
+
+    def reauthenticate(self, generation: int) -> bool:
+        """
+        Logs in again after a call made with session generation was refused as expired
+        When another thread already logged in again meanwhile, its session is used instead
+        """
+        with self._auth_lock:
+            if generation != self._session_generation:
+                return self.authenticated
+            logger.info(f"Session to {self.host} expired, authenticating again")
+            self.authenticated = False
+            return bool(self.authenticate())
+
+    def ensure_authenticated(self):
+        """
+        Only logs in when we don't already have a valid session
+        """
+        if self.authenticated:
+            return True
+        return self.authenticate()
+
+    def logout(self):
+        payload = self._payload("AuthenticationManagement", "logout")
+        self.authenticated = False
+        return self._send(payload)
+
+    def close(self):
+        """
+        Logs out and closes the underlying HTTP session
+        """
+        with self.lock:
+            try:
+                if self.authenticated:
+                    self.logout()
+            except Exception as exc:
+                logger.debug(f"Cannot logout from {self.host}: {exc}")
+            try:
+                self.req.api_session.close()
+            except AttributeError:
+                pass
+
+    @staticmethod
+    def is_session_expired(result: dict) -> bool:
+        """
+        Checks whether the API refused our call because the session isn't valid anymore
+        """
+        try:
+            if result["type"] == "exception":
+                message = str(result["message"]).lower()
+                return any(expired in message for expired in SESSION_EXPIRED_MESSAGES)
+        except (IndexError, KeyError, TypeError, AttributeError):
+            pass
+        return False
+
+    def _request_stream(self, payload: dict) -> Union[dict, bool]:
+        """
+        Sends a payload to Nakivo router and parses the reply while it's being received
+        """
+        url = f"{self.req.connected_server.rstrip('/')}/{self.req.endpoint}"
+        try:
+            response = self.req.api_session.post(
+                url,
+                json=payload,
+                headers=self.req.headers,
+                verify=self.cert_verify,
+                stream=True,
+            )
+        except requests.exceptions.RequestException as exc:
+            logger.error(f"Cannot reach {self.host}: {exc}")
+            logger.debug("Trace", exc_info=True)
+            return False
+        if response.status_code != 200:
+            logger.error(f"{self.host} replied with status code {response.status_code}")
+            response.close()
+            return False
+        # Let urllib3 handle gzip encoded replies
+        response.raw.decode_content = True
+
+        def on_close():
+            # Streamed replies are only fully read once consumed
+            self_metrics.inc(
+                "nakivo_exporter_rpc_response_bytes_total",
+                "How many bytes Nakivo API replied",
+                (("host", self.host), ("method", payload["method"])),
+                response.raw.tell(),
+            )
+            response.close()
+
+        try:
+            return parse_streamed_reply(response.raw, on_close=on_close)
+        except (ValueError, ijson.JSONError) as exc:
+            logger.error(f"Cannot decode json output: {exc}")
+            logger.debug("Trace", exc_info=True)
+            return None
+
+    def _request(self, payload: dict) -> Tuple[Union[dict, bool, None], int]:
+        """
+        Sends a payload to Nakivo router, returns the decoded reply and its size
+        """
+        # pylint: disable=protected-access (requestor() doesn't tell the reply size)
+        response = self.req._base_requestor(action="create", data=payload)
+        if not response:
+            return False, 0
+        try:
+            return json.loads(response.content), len(response.content)
+        except json.JSONDecodeError as exc:
+            logger.error(f"Cannot decode json output: {exc}")
+            logger.debug("Trace", exc_info=True)
+            return None, len(response.content)
+
+    def _send(self, payload: Union[dict, List[dict]], stream: bool = False):
+        """
+        Sends a payload, or a batch of them, to Nakivo router, recording call latency, reply size and errors
+        """
+        start = time.monotonic()
+        if stream and ijson:
+            result = self._request_stream(payload)
+            response_bytes = 0
+        else:
+            result, response_bytes = self._request(payload)
+        duration = time.monotonic() - start
+        if isinstance(payload, list):
+            self._observe_batch(payload, result, duration, response_bytes)
+            return result
+        try:
+            error = not result or result["type"] == "exception"
+        except (IndexError, KeyError, TypeError):
+            error = False
+        self_metrics.observe_rpc(
+            self.host, payload["method"], duration, response_bytes, error
+        )
         return result
 
+    def _observe_batch(
+        self, payloads: List[dict], result, duration: float, response_bytes: int
+    ) -> None:
+        """
+        Records every transaction of a batch under its own method, with the batch latency
+        Transactions share a single reply, whose size is recorded under the batch method
+        """
+        replies = {}
+        if isinstance(result, list):
+            for reply in result:
+                try:
+                    replies[reply["tid"]] = reply
+                except (KeyError, TypeError):
+                    pass
+        for payload in payloads:
+            reply = replies.get(payload["tid"], result)
+            try:
+                error = not reply or reply["type"] == "exception"
+            except (IndexError, KeyError, TypeError):
+                error = True
+            self_metrics.observe_rpc(self.host, payload["method"], duration, 0, error)
+        if response_bytes:
+            self_metrics.inc(
+                "nakivo_exporter_rpc_response_bytes_total",
+                "How many bytes Nakivo API replied",
+                (("host", self.host), ("method", "batch")),
+                response_bytes,
+            )
+
+    def _rpc(self, action: str, method: str, data=None, stream: bool = False):
+        """
+        Sends an RPC to Nakivo router, logging in again once if our session expired
+        With stream, the reply's data.children are parsed one by one as they're read
+        """
+        payload = self._payload(action, method, data)
+        generation = self._session_generation
+        result = self._send(payload, stream)
+        if self.is_session_expired(result):
+            if self.reauthenticate(generation):
+                result = self._send(payload, stream)
+        elif not result:
+            # Don't trust our session anymore, next call will login again
+            self.authenticated = False
+        return result
+
+    def _send_batch(self, calls: List[tuple]) -> Optional[list]:
+        """
+        Sends RPCs in a single request, returns their results in calls order, matched by transaction id
+        Returns None when the router answered something else than a list of replies
+        """
+        payloads = [self._payload(*call) for call in calls]
+        replies = self._send(payloads)
+        if not isinstance(replies, list):
+            # A failed request, or a single exception such as an expired session, applies to every call
+            if not replies or self.is_session_expired(replies):
+                return [replies] * len(calls)
+            return None
+        results = {}
+        for reply in replies:
+            try:
+                results[reply["tid"]] = reply
+            except (KeyError, TypeError):
+                pass
+        return [results.get(payload["tid"]) for payload in payloads]
+
+    def _rpc_batch(self, calls: List[tuple]) -> list:
+        """
+        Sends multiple RPCs as (action, method, data) to Nakivo router in a single HTTP request,
+        logging in again once if our session expired
+
+        When the router doesn't answer a batch with a list of replies, calls are sent one by one
+        (in parallel) until next login
+        """
+        if len(calls) < 2 or not self.batching:
+            return self._rpc_each(calls)
+        generation = self._session_generation
+        results = self._send_batch(calls)
+        if results and any(self.is_session_expired(result) for result in results):
+            if self.reauthenticate(generation):
+                results = self._send_batch(calls)
+        if results is None:
+            logger.info(
+                f"{self.host} didn't accept batched calls, sending them one by one until next login"
+            )
+            self.batching = False
+            return self._rpc_each(calls)
+        if not all(results):
+            # Don't trust our session anymore, next call will login again
+            self.authenticated = False
+        return results
+
+    def _rpc_each(self, calls: List[tuple]) -> list:
+        """
+        Sends RPCs one by one in parallel over our session
+        """
+        if len(calls) < 2:
+            return [self._rpc(*call) for call in calls]
+        with ThreadPoolExecutor(
+            max_workers=len(calls), thread_name_prefix="nakivo_rpc"
+        ) as executor:
+            return list(executor.map(lambda call: self._rpc(*call), calls))
+
+    def get_batch(self, calls: List[tuple]) -> list:
+        """
+        Returns results of multiple RPCs, such as LICENSE_RPC or JOB_LIST_RPC, queried in one round trip
+        """
+        return self._rpc_batch(calls)
+
     def get_license_info(self):
-        payload = {
-            "action": "LicensingManagement",
-            "method": "getLicenseInfo",
-            "data": None,
-            "type": "rpc",
-            "tid": 1,
-        }
-        return self.req.requestor(action="create", data=payload)
+        return self._rpc(*LICENSE_RPC)
 
-    def get_repository_info(self):
-        payload = {
-            "action": "BackupManagement",
-            "method": "getBackupRepository",
-            "data": [3],
-            "type": "rpc",
-            "tid": 1,
-        }
-        return self.req.requestor(action="create", data=payload)
+    def get_repository_info(self, repository_id: int):
+        return self._rpc(*get_repository_rpc(repository_id))
 
     def get_job_list(self):
-        payload = {
-            "action": "JobSummaryManagement",
-            "method": "getGroupInfo",
-            # data: [[Groups: int, or None for all groups], clientTimeOffsetToUtc: int, Get Children: bool]
-            "data": [[None], 0, True],
-            "type": "rpc",
-            "tid": 1,
-        }
-        return self.req.requestor(action="create", data=payload)
-
-    def get_job(self, job_ids: Union[int, List[int]]):
-        payload = {
-            "action": "JobSummaryManagement",
-            "method": "getJobInfo",
-            # [[idList: int], clientTimeOffsetToUtc: int]
-            "data": [job_ids, 0],
-            "type": "rpc",
-            "tid": 1,
-        }
-        return self.req.requestor(action="create", data=payload)
+        return self._rpc(*JOB_LIST_RPC)
+
+    def get_job(self, job_ids: Union[int, List[int]], stream: bool = False):
+        # [[idList: int], clientTimeOffsetToUtc: int]
+        return self._rpc(
+            "JobSummaryManagement", "getJobInfo", [job_ids, 0], stream=stream
+        )
+
+    @staticmethod
+    def get_job_markers(job_list: dict) -> dict:
+        """
+        Returns a change marker per job id from the group listing
 
-    def get_jobs(self):
-        result = self.get_job_list()
-        if result:
+        When the listing has an entry per job in the group's children, a job's marker is its own entry,
+        which changes whenever the job ran or changed state
+        Otherwise a job's marker is its group entry, whose summary changes whenever one of its jobs did
+        """
+        markers = {}
+        for group in job_list["data"]["children"]:
+            group_marker = json.dumps(
+                {
+                    key: value
+                    for key, value in group.items()
+                    if key not in ("childJobIds", "children")
+                },
+                sort_keys=True,
+                default=str,
+            )
+            job_ids = set(group["childJobIds"])
+            job_markers = {}
+            for child in group.get("children") or []:
+                try:
+                    if child["id"] in job_ids:
+                        job_markers[child["id"]] = json.dumps(
+                            child, sort_keys=True, default=str
+                        )
+                except (KeyError, TypeError):
+                    pass
+            for job_id in group["childJobIds"]:
+                markers[job_id] = job_markers.get(job_id, group_marker)
+        return markers
+
+    def iter_job_chunks(
+        self,
+        job_ids: List[int],
+        chunk_size: int = DEFAULT_JOB_CHUNK_SIZE,
+        parallel_requests: int = DEFAULT_PARALLEL_REQUESTS,
+    ) -> Iterator[dict]:
+        """
+        Queries job details in chunks of job ids, in parallel over our session
+        Yields getJobInfo results as they arrive, so they can be processed while other chunks are pending
+        When ijson is installed, jobs of a result are parsed one by one while they are consumed
+        """
+        if not chunk_size or len(job_ids) <= chunk_size:
+            yield self.get_job(job_ids, stream=True)
+            return
+        chunks = [
+            job_ids[index : index + chunk_size]
+            for index in range(0, len(job_ids), chunk_size)
+        ]
+        workers = max(min(parallel_requests, len(chunks)), 1)
+        # Streamed replies are read by the consumer one after the other, so a chunk holds its slot
+        # until its reply has been consumed, and no more than parallel_requests replies are open at once
+        slots = threading.Semaphore(workers)
+        cancelled = threading.Event()
+
+        def _get_chunk(chunk: List[int]):
+            while not slots.acquire(timeout=STREAM_SLOT_WAIT):
+                if cancelled.is_set():
+                    return None
             try:
-                job_children_ids = []
-                for child in result["data"]["children"]:
-                    job_children_ids += child["childJobIds"]
-            except (AttributeError, IndexError, TypeError):
-                logger.error("Cannot get job IDS")
-        else:
+                result = self.get_job(chunk, stream=True)
+                children = result["data"]["children"]
+            except (AttributeError, IndexError, KeyError, TypeError):
+                slots.release()
+                return result
+            except BaseException:
+                slots.release()
+                raise
+            if isinstance(children, list):
+                slots.release()
+            else:
+                result["data"]["children"] = _release_after(children, slots.release)
+            return result
+
+        with ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="nakivo_jobs"
+        ) as executor:
+            futures = [executor.submit(_get_chunk, chunk) for chunk in chunks]
+            try:
+                for future in as_completed(futures):
+                    yield future.result()
+            finally:
+                # Don't let chunk queries wait for replies nobody will consume
+                cancelled.set()
+                for future in futures:
+                    future.cancel()
+
+    @staticmethod
+    def _cache_jobs(jobs, markers: dict, job_cache: dict) -> Iterator[dict]:
+        """
+        Caches jobs while they are consumed, so streamed jobs aren't read twice
+        """
+        for job in jobs:
+            try:
+                job_cache[job["id"]] = (markers.get(job["id"]), job)
+            except (KeyError, TypeError):
+                pass
+            yield job
+
+    def iter_jobs(
+        self,
+        incremental: bool = False,
+        full_refresh_interval: float = DEFAULT_JOB_FULL_REFRESH_INTERVAL,
+        chunk_size: int = DEFAULT_JOB_CHUNK_SIZE,
+        parallel_requests: int = DEFAULT_PARALLEL_REQUESTS,
+        job_list: Optional[dict] = None,
+    ) -> Iterator[dict]:
+        """
+        Yields details of all jobs as getJobInfo shaped results, one per chunk of jobs
+        job_list is queried unless given, eg when it was batched with other calls
+
+        In incremental mode, only jobs whose group listing changed since last call are queried
+        again, others are served from our cache until full_refresh_interval expires
+        """
+        result = self.get_job_list() if job_list is None else job_list
+        if not result:
             logger.error("Obtaining job list failed")
+            yield result
+            return
+        try:
+            markers = self.get_job_markers(result)
+        except (AttributeError, IndexError, KeyError, TypeError):
+            logger.error("Cannot get job IDS")
+            # Probably an API exception, let the caller handle it
+            yield result
+            return
+
+        now = time.monotonic()
+        if (
+            not incremental
+            or now - self._last_full_job_refresh >= full_refresh_interval
+        ):
+            self._job_cache = {}
+        changed_ids = [
+            job_id
+            for job_id, marker in markers.items()
+            if self._job_cache.get(job_id, (None,))[0] != marker
+        ]
+        changed = set(changed_ids)
+        logger.debug(
+            f"Fetching {len(changed_ids)} of {len(markers)} jobs from {self.host}"
+        )
+
+        if incremental:
+            self_metrics.cache_access(
+                "job_details",
+                hits=len(markers) - len(changed_ids),
+                misses=len(changed_ids),
+            )
+
+        # Jobs that disappeared from the listing are dropped from the cache
+        job_cache = {
+            job_id: self._job_cache[job_id]
+            for job_id in markers
+            if job_id in self._job_cache and job_id not in changed
+        }
+        try:
+            if job_cache:
+                yield {
+                    "type": "rpc",
+                    "data": {"children": [job for _, job in job_cache.values()]},
+                }
+            complete = True
+            if changed_ids:
+                for job_result in self.iter_job_chunks(
+                    changed_ids, chunk_size, parallel_requests
+                ):
+                    try:
+                        if incremental:
+                            job_result["data"]["children"] = self._cache_jobs(
+                                job_result["data"]["children"], markers, job_cache
+                            )
+                    except (AttributeError, IndexError, KeyError, TypeError):
+                        # Failed jobs will be asked for again on next call
+                        complete = False
+                    yield job_result
+            if complete and len(changed_ids) == len(markers):
+                self._last_full_job_refresh = now
+        finally:
+            self._job_cache = job_cache if incremental else {}
+
+    def get_jobs(
+        self,
+        incremental: bool = False,
+        full_refresh_interval: float = DEFAULT_JOB_FULL_REFRESH_INTERVAL,
+        chunk_size: int = DEFAULT_JOB_CHUNK_SIZE,
+        parallel_requests: int = DEFAULT_PARALLEL_REQUESTS,
+    ):
+        """
+        Returns details of all jobs as a single getJobInfo shaped result
+        """
+        jobs = []
+        for job_result in self.iter_jobs(
+            incremental, full_refresh_interval, chunk_size, parallel_requests
+        ):
+            try:
+                jobs += job_result["data"]["children"]
+            except (AttributeError, IndexError, KeyError, TypeError):
+                # First failure is returned as is so the caller sees the API error
+                return job_result
+        return {"type": "rpc", "data": {"children": jobs}}
+
+
+class CircuitBreaker:
+    """
+    Skips a host after consecutive failures, so an unreachable director doesn't cost
+    a connect timeout on every collection
+
+    Once the cooldown expires, a single probe collection is let through: success closes the circuit,
+    failure opens it again for twice as long, up to max_backoff
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(
+        self,
+        host: str,
+        failures: int = DEFAULT_BREAKER_FAILURES,
+        backoff: float = DEFAULT_BREAKER_BACKOFF,
+        max_backoff: float = DEFAULT_BREAKER_MAX_BACKOFF,
+    ):
+        self.host = host
+        self.failures = failures
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self._times_opened = 0
+        self._retry_at = 0
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self) -> bool:
+        return self.state != self.CLOSED
+
+    def configure(self, failures: int, backoff: float, max_backoff: float) -> None:
+        with self._lock:
+            self.failures = failures
+            self.backoff = backoff
+            self.max_backoff = max_backoff
+
+    def allow(self, now: Optional[float] = None) -> bool:
+        """
+        Returns whether the host may be collected now
+        """
+        if self.failures <= 0:
+            return True
+        if now is None:
+            now = time.monotonic()
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and now >= self._retry_at:
+                # Let a single probe through
+                self.state = self.HALF_OPEN
+                return True
+            return False
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.state = self.CLOSED
+            self.consecutive_failures = 0
+            self._times_opened = 0
+
+    def record_failure(self, now: Optional[float] = None) -> None:
+        if now is None:
+            now = time.monotonic()
+        with self._lock:
+            self.consecutive_failures += 1
+            if self.failures <= 0:
+                return
+            if (
+                self.state == self.HALF_OPEN
+                or self.consecutive_failures >= self.failures
+            ):
+                cooldown = min(self.backoff * 2**self._times_opened, self.max_backoff)
+                self._times_opened += 1
+                self._retry_at = now + cooldown
+                self.state = self.OPEN
+                logger.warning(
+                    f"{self.host} failed {self.consecutive_failures} times in a row, skipping it for {cooldown}s"
+                )
+
+
+class NakivoAPIRegistry:
+    """
+    Keeps one authenticated NakivoAPI client per host across scrapes
+    so we don't pay a TLS handshake and a login on every scrape
+    """
+
+    def __init__(
+        self,
+        idle_timeout: float = DEFAULT_SESSION_IDLE_TIMEOUT,
+        request_timeout: float = DEFAULT_REQUEST_TIMEOUT,
+    ):
+        self.idle_timeout = idle_timeout
+        self.request_timeout = request_timeout
+        # Circuit breaker settings, see configure() to change them
+        self.breaker_failures = DEFAULT_BREAKER_FAILURES
+        self.breaker_backoff = DEFAULT_BREAKER_BACKOFF
+        self.breaker_max_backoff = DEFAULT_BREAKER_MAX_BACKOFF
+        self._clients = {}
+        self._last_used = {}
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+    def get(
+        self, host: str, username: str, password: str, cert_verify: bool = True
+    ) -> NakivoAPI:
+        """
+        Returns an existing client for given host config, or creates a new one
+        """
+        self.evict_idle()
+        key = (host, username, password, cert_verify)
+        with self._lock:
+            api = self._clients.get(key)
+        if api is None:
+            # Creating a session may take long, don't hold the registry lock meanwhile
+            api = NakivoAPI(host, username, password, cert_verify, self.request_timeout)
+            with self._lock:
+                if key in self._clients:
+                    api.close()
+                    api = self._clients[key]
+                else:
+                    self._clients[key] = api
+        with self._lock:
+            self._last_used[key] = time.monotonic()
+        return api
+
+    def configure(
+        self,
+        idle_timeout: float,
+        request_timeout: float,
+        breaker_failures: int,
+        breaker_backoff: float,
+        breaker_max_backoff: float,
+    ) -> None:
+        """
+        Changes settings of the registry, and of the clients and circuit breakers it already holds
+        An open circuit keeps its current cooldown, new backoff settings apply from its next failure
+        """
+        with self._lock:
+            self.idle_timeout = idle_timeout
+            self.request_timeout = request_timeout
+            self.breaker_failures = breaker_failures
+            self.breaker_backoff = breaker_backoff
+            self.breaker_max_backoff = breaker_max_backoff
+            apis = list(self._clients.values())
+            breakers = list(self._breakers.values())
+        for api in apis:
+            api.set_timeout(request_timeout)
+        for breaker in breakers:
+            breaker.configure(breaker_failures, breaker_backoff, breaker_max_backoff)
+
+    def get_breaker(self, host: str) -> CircuitBreaker:
+        """
+        Returns the circuit breaker of given host, breakers outlive clients
+        """
+        with self._lock:
+            try:
+                return self._breakers[host]
+            except KeyError:
+                breaker = CircuitBreaker(
+                    host,
+                    self.breaker_failures,
+                    self.breaker_backoff,
+                    self.breaker_max_backoff,
+                )
+                self._breakers[host] = breaker
+                return breaker
+
+    def remove(self, host: str) -> None:
+        """
+        Closes and forgets every client and the circuit breaker of given host
+        """
+        with self._lock:
+            self._breakers.pop(host, None)
+            keys = [key for key in self._clients if key[0] == host]
+            apis = [self._clients.pop(key) for key in keys]
+            for key in keys:
+                self._last_used.pop(key, None)
+        for api in apis:
+            api.close()
 
-        job_result = self.get_job(job_children_ids)
-        return job_result
+    def evict_idle(self, now: Optional[float] = None) -> None:
+        """
+        Closes clients that haven't been used for idle_timeout seconds
+        """
+        if now is None:
+            now = time.monotonic()
+        with self._lock:
+            keys = [
+                key
+                for key, last_used in self._last_used.items()
+                if now - last_used > self.idle_timeout
+            ]
+            apis = [self._clients.pop(key) for key in keys]
+            for key in keys:
+                self._last_used.pop(key, None)
+        for api in apis:
+            logger.info(f"Closing idle session to {api.host}")
+            api.close()
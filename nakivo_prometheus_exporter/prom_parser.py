@@ -9,19 +9,66 @@ __site__ = "https://www.github.com/netinvent/nakivo_prometheus_exporter"
 __description__ = "Naviko API Prometheus data exporter"
 __copyright__ = "Copyright (C) 2024 NetInvent"
 __license__ = "GPL-3.0-only"
-__build__ = "2024042501"
+__build__ = "2026101701"
 
 
 import sys
+import time
 from argparse import ArgumentParser
-from typing import Union
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Union, List, Optional, Tuple
 from ruamel.yaml import YAML
 from pathlib import Path
 from logging import getLogger
-from nakivo_prometheus_exporter.nakivo_api import NakivoAPI
+from nakivo_prometheus_exporter.exposition import MetricSet, Sample, render_text
+from nakivo_prometheus_exporter.self_metrics import (
+    self_metrics,
+    get_self_metrics_enabled,
+)
+from nakivo_prometheus_exporter.data_cache import (
+    DataCache,
+    add_data,
+    get_max_staleness,
+)
+from nakivo_prometheus_exporter.nakivo_api import (
+    NakivoAPI,
+    NakivoAPIRegistry,
+    LICENSE_RPC,
+    JOB_LIST_RPC,
+    get_repository_rpc,
+    DEFAULT_SESSION_IDLE_TIMEOUT,
+    DEFAULT_JOB_FULL_REFRESH_INTERVAL,
+    DEFAULT_JOB_CHUNK_SIZE,
+    DEFAULT_PARALLEL_REQUESTS,
+    DEFAULT_BREAKER_FAILURES,
+    DEFAULT_BREAKER_BACKOFF,
+    DEFAULT_BREAKER_MAX_BACKOFF,
+)
 
 logger = getLogger()
 
+# How many Nakivo hosts are scraped at the same time
+DEFAULT_MAX_CONCURRENCY = 4
+# How long (seconds) a single Nakivo host may take before being reported as down
+DEFAULT_HOST_TIMEOUT = 50
+# How long (seconds) collected data of a type is reused before querying it again
+# job_list also sets how long the jobs' backup metrics are reused, job_details how long
+# unchanged jobs are served from cache in incremental mode
+DEFAULT_REFRESH_INTERVALS = {
+    "license": 3600,
+    "job_list": 0,
+    "job_details": DEFAULT_JOB_FULL_REFRESH_INTERVAL,
+    "repositories": 1800,
+}
+
+# Host settings Nakivo API clients are created with, changing them needs a new session
+CLIENT_KEYS = ("username", "password", "cert_verify")
+
+# Authenticated Nakivo API sessions are kept between scrapes
+api_registry = NakivoAPIRegistry()
+# Last known good data of every host, served when collecting it fails
+data_cache = DataCache()
+
 
 # Monkeypatching ruamel.yaml ordreddict so we get to use pseudo dot notations
 # eg data.g('my.array.keys') == data['my']['array']['keys']
@@ -51,155 +98,441 @@ def load_config_file(config_file: Path) -> Union[bool, dict]:
         return False
 
 
-def intercept_api_errors(api_return: dict, host: str) -> tuple[bool, str]:
+def intercept_api_errors(
+    api_return: dict, host: str, metrics: MetricSet, rpc: str
+) -> bool:
     """
     Intercept API return and check for errors
+    rpc label keeps errors of different calls to the same host apart
     """
     try:
         if api_return["type"] == "exception":
             logger.error(f"API replied: {api_return['message']}")
             logger.debug(f"Full API return: {api_return}")
 
-            prom_data = "# HELP nakivo_api_error\n\
-# TYPE nakivo_api_error gauge\n"
-            prom_data += f'nakivo_api_error{{host="{host}"}} 1\n'
-            return True, prom_data
+            labels = (("host", host), ("rpc", rpc))
+            family = metrics.family(
+                "nakivo_api_error", "Did the Nakivo API reply with an error"
+            )
+            # Chunked calls may fail more than once, report a single sample
+            if all(sample.labels != labels for sample in family.samples):
+                family.samples.append(Sample(labels, 1))
+            return True
     except (IndexError, KeyError, TypeError, AttributeError):
         pass
-    return False, None
+    return False
+
+
+# Nakivo license data key, metric name, help, divider
+LICENSE_METRICS = (
+    ("installed", "nakivo_license_installed", "Is the Nakivo instance licensed", None),
+    ("usedVms", "nakivo_license_vmcount", "How many VMs do we backup", None),
+    ("usedSockets", "nakivo_license_sockets", "How many VMs do we backup", None),
+    (
+        "usedEc2Instances",
+        "nakivo_license_ec2count",
+        "How many EC2 instances do we backup",
+        None,
+    ),
+    (
+        "usedPhysicalServers",
+        "nakivo_license_physicalservercount",
+        "How many physical servers do we backup",
+        None,
+    ),
+    (
+        "usedPhysicalWorkstations",
+        "nakivo_license_physicalworkstationcount",
+        "How many physical workstations do we backup",
+        None,
+    ),
+    (
+        "usedOffice365Users",
+        "nakivo_license_o365count",
+        "How many Office 365 users do we backup",
+        None,
+    ),
+    (
+        "usedOracleDatabases",
+        "nakivo_license_oraclecount",
+        "How many oracle databases do we backup",
+        None,
+    ),
+    (
+        "usedMonitoredVms",
+        "nakivo_license_monitoredvm",
+        "How many vms are monitored",
+        None,
+    ),
+    # milliseconds to seconds
+    (
+        "expiresIn",
+        "nakivo_license_expiration",
+        "When will the license expire (seconds)",
+        1000,
+    ),
+)
+
+
+# Nakivo backup repository data key, metric name, help
+REPOSITORY_METRICS = (
+    ("size", "nakivo_repository_size", "Repository capacity (bytes)"),
+    ("freeSpace", "nakivo_repository_free_space", "Repository free space (bytes)"),
+    (
+        "usedSpace",
+        "nakivo_repository_used_space",
+        "Repository space used by backups (bytes)",
+    ),
+    ("dedupRatio", "nakivo_repository_dedup_ratio", "Repository deduplication ratio"),
+)
+# Repository states reported as okay (0) and warnings (1), any other state is a failure (2)
+REPOSITORY_OK_STATES = ("OK", "AVAILABLE")
+REPOSITORY_WARNING_STATES = ("BUSY", "MAINTENANCE", "DETACHED")
+
+
+# Job object key holding when the last run finished (milliseconds since epoch)
+LAST_RUN_KEY = "lrFinishDate"
+
+
+def backup_state(state) -> int:
+    """
+    States used in prometheus will be 0 = all okay, 1 = warnings, 2 = failures
+    """
+    if isinstance(state, str):
+        if state in ("SUCCEEDED"):
+            return 0
+        if state in ("RUNNING", "DEMAND", "SCHEDULED", "WAITING", "SKIPPED"):
+            return 1
+        return 2
+    # If lrState is null, it means that the job has not yet been executed once on the child, let's put a warning state by default
+    return 1
 
 
-def license_to_prometheus(license_data: dict, host: str):
+def job_status(status) -> Optional[int]:
+    """
+    Nakivo job status colors to 0 = all okay, 1 = warnings, 2 = failures, 3 = disabled
+    """
+    return {"GREEN": 0, "YELLOW": 1, "RED": 2, "GRAY": 3}.get(status)
+
+
+def milliseconds_to_seconds(value) -> Optional[int]:
+    if isinstance(value, (int, float)):
+        return round(value / 1000)
+    return None
+
+
+# Nakivo job object key, metric name, help, converter
+# Converters return None for values that shouldn't be reported, no converter exports numbers as is
+# Every metric is extracted in the same pass over job objects, samples are labelled by host, object and job_name
+OBJECT_METRICS = (
+    (
+        "lrState",
+        "nakivo_backup_state",
+        "backup okay (0), warnings (1), failed (2)",
+        backup_state,
+    ),
+    (
+        "lrDuration",
+        "nakivo_backup_duration",
+        "Backup duration (seconds)",
+        milliseconds_to_seconds,
+    ),
+    (
+        "lrDataTransferredUncompressed",
+        "nakivo_backup_size",
+        "Backup size (bytes)",
+        None,
+    ),
+    (
+        "lrSpeed",
+        "nakivo_backup_speed",
+        "Backup transfer speed of last run (bytes per second)",
+        None,
+    ),
+    (
+        "lastSuccessDate",
+        "nakivo_backup_last_success_timestamp",
+        "When did the last successful backup finish (seconds since epoch)",
+        milliseconds_to_seconds,
+    ),
+    (
+        "pointsCount",
+        "nakivo_backup_recovery_points",
+        "How many recovery points are kept",
+        None,
+    ),
+)
+# Nakivo job key, metric name, help, converter, samples are labelled by host and job_name
+JOB_METRICS = (
+    (
+        "status",
+        "nakivo_job_status",
+        "job okay (0), warnings (1), failed (2), disabled (3)",
+        job_status,
+    ),
+    (
+        "nextRunDate",
+        "nakivo_job_next_run_timestamp",
+        "When is the job scheduled to run next (seconds since epoch)",
+        milliseconds_to_seconds,
+    ),
+)
+
+
+def license_to_prometheus(
+    license_data: dict, host: str, metrics: MetricSet
+) -> MetricSet:
     """
     Extract Nakivo license status from Job result
     """
-    has_errors, prom_data = intercept_api_errors(license_data, host)
-    if has_errors:
-        return prom_data
+    if intercept_api_errors(license_data, host, metrics, "license"):
+        return metrics
 
-    try:
-        installed = 1 if license_data["data"]["installed"] else 0
-    except (IndexError, KeyError, TypeError, AttributeError):
-        installed = 0
     try:
         client = license_data["data"]["client"]
     except (IndexError, KeyError, TypeError, AttributeError):
         client = None
+    labels = (("host", host), ("client", str(client)))
+
+    for key, name, documentation, divider in LICENSE_METRICS:
+        try:
+            value = license_data["data"][key]
+            if key == "installed":
+                value = 1 if value else 0
+            elif divider:
+                value = round(value / divider)
+        except (IndexError, KeyError, TypeError, AttributeError):
+            value = 0
+        metrics.add(name, documentation, labels, value)
+    return metrics
+
+
+def repositories_to_prometheus(
+    repository_data: dict, host: str, metrics: MetricSet
+) -> MetricSet:
+    """
+    Extract Nakivo backup repository capacity and state
+    Fields missing from the repository object are not reported, so they don't look like empty repositories
+    """
+    if intercept_api_errors(repository_data, host, metrics, "repositories"):
+        return metrics
+
     try:
-        vmcount = license_data["data"]["usedVms"]
-    except (IndexError, KeyError, TypeError, AttributeError):
-        vmcount = 0
-    try:
-        sockets = license_data["data"]["usedSockets"]
-    except (IndexError, KeyError, TypeError, AttributeError):
-        sockets = 0
-    try:
-        ec2 = license_data["data"]["usedEc2Instances"]
-    except (IndexError, KeyError, TypeError, AttributeError):
-        ec2 = 0
-    try:
-        physical_servers = license_data["data"]["usedPhysicalServers"]
-    except (IndexError, KeyError, TypeError, AttributeError):
-        physical_servers = 0
-    try:
-        physical_workstations = license_data["data"]["usedPhysicalWorkstations"]
-    except (IndexError, KeyError, TypeError, AttributeError):
-        physical_workstations = 0
-    try:
-        o365users = license_data["data"]["usedOffice365Users"]
-    except (IndexError, KeyError, TypeError, AttributeError):
-        o365users = 0
-    try:
-        oracledb = license_data["data"]["usedOracleDatabases"]
-    except (IndexError, KeyError, TypeError, AttributeError):
-        oracledb = 0
-    try:
-        monitoredvm = license_data["data"]["usedMonitoredVms"]
-    except (IndexError, KeyError, TypeError, AttributeError):
-        monitoredvm = 0
-    try:
-        expiration = round(
-            license_data["data"]["expiresIn"] / 1000
-        )  # milliseconds to seconds
+        repositories = repository_data["data"]["children"]
     except (IndexError, KeyError, TypeError, AttributeError):
-        expiration = 0
-
-    prom_data = f'# HELP nakivo_license_installed Is the Nakivo instance licensed\n\
-# TYPE nakivo_license_installed gauge\n\
-nakivo_license_installed{{host="{host}",client="{client}"}} {installed}\n\
-# HELP nakivo_license_vmcount How many VMs do we backup\n\
-# TYPE nakivo_license_vmcount gauge\n\
-nakivo_license_vmcount{{host="{host}",client="{client}"}} {vmcount}\n\
-# HELP nakivo_license_sockets How many VMs do we backup\n\
-# TYPE nakivo_license_sockets gauge\n\
-nakivo_license_sockets{{host="{host}",client="{client}"}} {sockets}\n\
-# HELP nakivo_license_ec2count How many EC2 instances do we backup\n\
-# TYPE nakivo_license_ec2count gauge\n\
-nakivo_license_ec2count{{host="{host}",client="{client}"}} {ec2}\n\
-# HELP nakivo_license_physicalservercount How many physical servers do we backup\n\
-# TYPE nakivo_license_physicalservercount gauge\n\
-nakivo_license_physicalservercount{{host="{host}",client="{client}"}} {physical_servers}\n\
-# HELP nakivo_license_physicalworkstationcount How many physical workstations do we backup\n\
-# TYPE nakivo_license_physicalworkstationcount gauge\n\
-nakivo_license_physicalworkstationcount{{host="{host}",client="{client}"}} {physical_workstations}\n\
-# HELP nakivo_license_o365count How many Office 365 users do we backup\n\
-# TYPE nakivo_license_o365count gauge\n\
-nakivo_license_o365count{{host="{host}",client="{client}"}} {o365users}\n\
-# HELP nakivo_license_oraclecount How many oracle databases do we backup\n\
-# TYPE nakivo_license_oraclecount gauge\n\
-nakivo_license_oraclecount{{host="{host}",client="{client}"}} {oracledb}\n\
-# HELP nakivo_license_monitoredvm How many vms are monitored\n\
-# TYPE nakivo_license_monitoredvm gauge\n\
-nakivo_license_monitoredvm{{host="{host}",client="{client}"}} {monitoredvm}\n\
-# HELP nakivo_license_expiration When will the license expire (seconds)\n\
-# TYPE nakivo_license_expiration gauge\n\
-nakivo_license_expiration{{host="{host}",client="{client}"}} {expiration}\n'
-    return prom_data
-
-
-def get_vm_backup_result(job_result: dict, host: str, filter_active_only: bool = True):
-    """
-    Extract VM backup status from Nakvio Job result
-    """
-    has_errors, prom_data = intercept_api_errors(job_result, host)
-    if has_errors:
-        return prom_data
-
-    vm_job_state = []
-    prom_data = "# HELP nakivo_backup_state backup okay (0), warnings (1), failed (2)\n\
-# TYPE nakivo_backup_state gauge\n\
-# HELP nakivo_backup_duration Backup duration (seconds)\n\
-# TYPE nakivo_backup_duration gauge\n\
-# HELP nakivo_backup_size Backup size (bytes)\n\
-# TYPE nakivo_backup_size gauge\n"
+        repositories = [repository_data["data"]]
+    for repository in repositories:
+        labels = (("host", host), ("repository", str(repository.get("name"))))
+        for key, name, documentation in REPOSITORY_METRICS:
+            value = repository.get(key)
+            if isinstance(value, (int, float)):
+                metrics.add(name, documentation, labels, value)
+        state = repository.get("state")
+        if state is None:
+            continue
+        if state in REPOSITORY_OK_STATES:
+            num_state = 0
+        elif state in REPOSITORY_WARNING_STATES:
+            num_state = 1
+        else:
+            num_state = 2
+        metrics.add(
+            "nakivo_repository_state",
+            "repository okay (0), busy or in maintenance (1), failed (2)",
+            labels,
+            num_state,
+        )
+    return metrics
+
+
+def get_vm_backup_result(
+    job_result: dict,
+    host: str,
+    metrics: MetricSet,
+    filter_active_only: bool = True,
+    sample_timestamps: bool = False,
+) -> MetricSet:
+    """
+    Extract VM backup status from Nakvio Job result, see OBJECT_METRICS and JOB_METRICS
+    When sample_timestamps is set, object samples carry the time Nakivo last ran the object's backup
+    """
+    if intercept_api_errors(job_result, host, metrics, "jobs"):
+        return metrics
+
+    # Get families once so we don't look them up for every object
+    object_fields = [
+        (key, metrics.family(name, documentation), converter)
+        for key, name, documentation, converter in OBJECT_METRICS
+    ]
+    job_fields = [
+        (key, metrics.family(name, documentation), converter)
+        for key, name, documentation, converter in JOB_METRICS
+    ]
     for job in job_result["data"]["children"]:
+        job_name = job["name"]
+        labels = (("host", host), ("job_name", job_name))
+        # Disabled jobs still report their status, only their objects are filtered out
+        for key, family, converter in job_fields:
+            value = job.get(key)
+            value = converter(value) if converter else value
+            if isinstance(value, (int, float)):
+                family.samples.append(Sample(labels, value))
         if filter_active_only:
             if job["status"] in ("GRAY"):
                 continue
-        job_name = job["name"]
         for vm in job["objects"]:
-            name = vm["sourceName"]
-            state = vm["lrState"]
-            # States used in prometheus will be 0 = all okay, 1 = warnings, 2 = failures
-            if isinstance(state, str):
-                if state in ("SUCCEEDED"):
-                    num_state = 0
-                elif state in ("RUNNING", "DEMAND", "SCHEDULED", "WAITING", "SKIPPED"):
-                    num_state = 1
-                else:
-                    num_state = 2
+            labels = (
+                ("host", host),
+                ("object", vm["sourceName"]),
+                ("job_name", job_name),
+            )
+            timestamp = None
+            if sample_timestamps:
+                try:
+                    timestamp = vm[LAST_RUN_KEY] / 1000  # milliseconds to seconds
+                except (KeyError, TypeError):
+                    pass
+            for key, family, converter in object_fields:
+                value = vm.get(key)
+                value = converter(value) if converter else value
+                # Fields the director doesn't report are left out
+                if isinstance(value, (int, float)):
+                    family.samples.append(Sample(labels, value, timestamp))
+    # Don't expose families of fields no object had
+    for _, family, _ in object_fields + job_fields:
+        if not family.samples:
+            metrics.families.pop(family.name, None)
+    return metrics
+
+
+def serve_data(
+    host: str, data: str, fragment: MetricSet, metrics: MetricSet, failed: bool
+) -> MetricSet:
+    """
+    Adds freshly collected data of given type to host metrics, and remembers it
+    When collecting it failed, last known good data is served instead, along with the API errors
+    """
+    if not failed:
+        data_cache.store(host, data, fragment)
+        return add_data(metrics, host, data, fragment, 0)
+    cached = data_cache.get(host, data)
+    if not cached:
+        return metrics.update(fragment)
+    try:
+        errors = fragment.families["nakivo_api_error"]
+        metrics.family(errors.name, errors.documentation).samples.extend(errors.samples)
+    except KeyError:
+        pass
+    logger.warning(f"Serving {data} data of {host} collected {round(cached[1])}s ago")
+    return add_data(metrics, host, data, *cached)
+
+
+def get_refresh_interval(
+    host_config: dict, data: str, default: Optional[float] = None
+) -> float:
+    """
+    Returns how long collected data of a type is reused for a host before querying it again
+    """
+    try:
+        return float(host_config["refresh_intervals"][data])
+    except (AttributeError, ValueError, TypeError, KeyError):
+        return float(DEFAULT_REFRESH_INTERVALS[data] if default is None else default)
+
+
+def get_fresh_data(
+    host: str, data: str, interval: float
+) -> Optional[Tuple[MetricSet, float]]:
+    """
+    Returns cached data of a type and its age while its refresh interval hasn't expired
+    """
+    cached = data_cache.get(host, data, interval) if interval > 0 else None
+    self_metrics.cache_access(data, hits=1 if cached else 0, misses=0 if cached else 1)
+    return cached
+
+
+def collect_license(license: dict, host: str) -> Tuple[MetricSet, bool]:
+    """
+    Returns license metrics of a host, and whether collecting them failed
+    """
+    metrics = MetricSet()
+    try:
+        if not license:
+            logger.error(f"Cannot get license data for {host}")
+            metrics.add(
+                "nakivo_license_installed",
+                "Is the Nakivo instance licensed",
+                (("host", host),),
+                0,
+            )
+            return metrics, True
+        license_to_prometheus(license, host, metrics)
+        return metrics, "nakivo_api_error" in metrics.families
+    except Exception as exc:
+        logger.error(f"Cannot retrieve license data for {host}: {exc}")
+        logger.debug("Trace", exc_info=True)
+        return metrics, True
+
+
+def collect_repositories(
+    repositories: List[dict], host: str, repository_ids: List[int]
+) -> Tuple[MetricSet, bool]:
+    """
+    Returns backup repository metrics of a host, and whether collecting them failed
+    """
+    metrics = MetricSet()
+    try:
+        for repository_id, repository in zip(repository_ids, repositories):
+            if not repository:
+                logger.error(f"Cannot get repository {repository_id} data for {host}")
+                return metrics, True
+            repositories_to_prometheus(repository, host, metrics)
+        return metrics, "nakivo_api_error" in metrics.families
+    except Exception as exc:
+        logger.error(f"Cannot retrieve repository data for {host}: {exc}")
+        logger.debug("Trace", exc_info=True)
+        return metrics, True
+
+
+def collect_jobs(
+    api: NakivoAPI,
+    host: str,
+    incremental: bool,
+    full_refresh_interval: float,
+    chunk_size: int,
+    parallel_requests: int,
+    sample_timestamps: bool,
+    job_list: Optional[dict] = None,
+) -> Tuple[MetricSet, bool]:
+    """
+    Returns backup metrics of all jobs of a host, and whether collecting them failed
+    """
+    metrics = MetricSet()
+    failed = False
+    try:
+        # Job details come in chunks, process each one as soon as it arrives
+        for jobs in api.iter_jobs(
+            incremental,
+            full_refresh_interval,
+            chunk_size,
+            parallel_requests,
+            job_list,
+        ):
+            if not jobs:
+                logger.error(f"Cannot get job info for {host}")
+                failed = True
             else:
-                # If lrState is null, it means that the job has not yet been executed once on the child, let's put a warning state by default
-                num_state = 1
-            prom_data += f'nakivo_backup_state{{host="{host}",object="{name}",job_name="{job_name}"}} {num_state}\n'
-            duration = round(vm["lrDuration"] / 1000)  # milliseconds to seconds
-            prom_data += f'nakivo_backup_duration{{host="{host}",object="{name}",job_name="{job_name}"}} {duration}\n'
-            data_size = vm["lrDataTransferredUncompressed"]
-            prom_data += f'nakivo_backup_size{{host="{host}",object="{name}",job_name="{job_name}"}} {data_size}\n'
-    return prom_data
+                get_vm_backup_result(
+                    jobs, host, metrics, sample_timestamps=sample_timestamps
+                )
+    except Exception as exc:
+        logger.error(f"Cannot retrieve job data for {host}: {exc}")
+        logger.debug("Trace", exc_info=True)
+        failed = True
+    # A single failed chunk would leave jobs missing, serve last known good jobs as a whole
+    return metrics, failed or "nakivo_api_error" in metrics.families
 
 
-def get_nakivo_data(host_config):
+def get_nakivo_data(host_config) -> Union[bool, MetricSet]:
     """
     Connects to Nakivo API and exports job data
     """
@@ -208,6 +541,33 @@ def get_nakivo_data(host_config):
         username = host_config["username"]
         password = host_config["password"]
         cert_verify = host_config["cert_verify"]
+        sample_timestamps = host_config.get("sample_timestamps", False) is True
+        incremental_jobs = host_config.get("incremental_jobs", False) is True
+        # job_full_refresh_interval predates refresh_intervals
+        job_details_interval = get_refresh_interval(
+            host_config,
+            "job_details",
+            host_config.get(
+                "job_full_refresh_interval", DEFAULT_JOB_FULL_REFRESH_INTERVAL
+            ),
+        )
+        job_chunk_size = int(host_config.get("job_chunk_size", DEFAULT_JOB_CHUNK_SIZE))
+        parallel_requests = int(
+            host_config.get("parallel_requests", DEFAULT_PARALLEL_REQUESTS)
+        )
+        repository_ids = [
+            int(repository_id)
+            for repository_id in host_config.get("repository_ids") or []
+        ]
+        # Refresh interval of every data type we collect
+        intervals = {
+            "license": get_refresh_interval(host_config, "license"),
+            "jobs": get_refresh_interval(host_config, "job_list"),
+        }
+        if repository_ids:
+            intervals["repositories"] = get_refresh_interval(
+                host_config, "repositories"
+            )
     except (AttributeError, ValueError, TypeError, KeyError):
         try:
             # pylint: disable=used-before-assignment
@@ -216,38 +576,331 @@ def get_nakivo_data(host_config):
             logger.error("Bogus host config")
         return False
 
-    prom_data = "# HELP nakivo_api_authentication Do we have an API auth error\n\
-# TYPE nakivo_api_authentication_error gauge\n"
-
-    api = NakivoAPI(host, username, password, cert_verify)
-    if not api.authenticate():
-        logger.error(f"Authentication failure for {host} as {username}")
-        prom_data += f'nakivo_api_authentication_error{{host="{host}"}} 1\n'
-        return prom_data
-    else:
-        prom_data += f'nakivo_api_authentication_error{{host="{host}"}} 0\n'
+    metrics = MetricSet()
+    auth_documentation = "Do we have an API auth error"
 
+    # Don't spend a connection timeout on every collection of a host that keeps failing
+    breaker = api_registry.get_breaker(host)
+    if not breaker.allow():
+        logger.debug(
+            f"Skipping {host} after {breaker.consecutive_failures} consecutive failures"
+        )
+        return False
+    # Host counts as healthy once we could authenticate against it
+    reachable = False
     try:
-        license = api.get_license_info()
-        if not license:
-            logger.error(f"Cannot get license data for {host}")
-            prom_data += f'nakivo_license_installed{{host="{host}"}} 0'
+        api = api_registry.get(host, username, password, cert_verify)
+    except ValueError as exc:
+        logger.error(f"Cannot connect to {host}: {exc}")
+        breaker.record_failure()
+        return False
+    # Sessions are shared between scrapes, don't let two scrapes use the same one at once
+    # A scrape still holding the session means the host hangs, don't pile up threads behind it
+    if not api.lock.acquire(timeout=api_registry.request_timeout):
+        logger.error(f"Previous scrape of {host} is still running")
+        breaker.record_failure()
+        return False
+    try:
+        authenticated = bool(api.ensure_authenticated())
+        errors = MetricSet()
+        errors.add(
+            "nakivo_api_authentication_error",
+            auth_documentation,
+            (("host", host),),
+            0 if authenticated else 1,
+        )
+        # Served along last known good data while the host is down or skipped
+        data_cache.store_errors(host, errors)
+        if not authenticated:
+            # A refused login means the host is down, callers then serve its last known good data
+            logger.error(f"Authentication failure for {host} as {username}")
+            return False
+        reachable = True
+        metrics.update(errors)
+
+        # Only query data whose refresh interval expired, serve the rest from cache
+        due = []
+        for data, interval in intervals.items():
+            cached = get_fresh_data(host, data, interval)
+            if cached:
+                add_data(metrics, host, data, *cached)
+            else:
+                due.append(data)
+        # License, job list and repositories due are queried in a single round trip,
+        # job details follow once we know the job ids
+        calls = []
+        if "license" in due:
+            calls.append(LICENSE_RPC)
+        if "jobs" in due:
+            calls.append(JOB_LIST_RPC)
+        if "repositories" in due:
+            calls += [
+                get_repository_rpc(repository_id) for repository_id in repository_ids
+            ]
+        results = api.get_batch(calls) if calls else []
+
+        if "license" in due:
+            fragment, failed = collect_license(results.pop(0), host)
+            serve_data(host, "license", fragment, metrics, failed)
+        if "jobs" in due:
+            fragment, failed = collect_jobs(
+                api,
+                host,
+                incremental_jobs,
+                job_details_interval,
+                job_chunk_size,
+                parallel_requests,
+                sample_timestamps,
+                results.pop(0),
+            )
+            serve_data(host, "jobs", fragment, metrics, failed)
+        if "repositories" in due:
+            fragment, failed = collect_repositories(results, host, repository_ids)
+            serve_data(host, "repositories", fragment, metrics, failed)
+    finally:
+        api.lock.release()
+        if reachable:
+            breaker.record_success()
         else:
-            prom_data += license_to_prometheus(license, host)
-    except Exception as exc:
-        logger.error(f"Cannot retrieve license data for {host}: {exc}")
-        logger.debug("Trace", exc_info=True)
+            breaker.record_failure()
+    return metrics
+
 
+def get_host_label(host_config: dict) -> str:
+    """
+    Returns the host label used in prometheus series for a given host config
+    """
     try:
-        jobs = api.get_jobs()
-        if not jobs:
-            logger.error(f"Cannot get job info for {host}")
-        else:
-            prom_data += get_vm_backup_result(jobs, host)
-    except Exception as exc:
-        logger.error(f"Cannot retrieve job data for {host}: {exc}")
-        logger.debug("Trace", exc_info=True)
-    return prom_data
+        return host_config["host"]
+    except (AttributeError, ValueError, TypeError, KeyError):
+        return "unknown"
+
+
+def get_host_name(host_config: dict) -> Optional[str]:
+    """
+    Returns the name a host is listed under in nakivo_hosts (the key without value)
+    """
+    try:
+        for key, value in host_config.items():
+            if value is None:
+                return str(key)
+    except AttributeError:
+        pass
+    return None
+
+
+def find_host_config(host_configs: List[dict], target: str) -> Optional[dict]:
+    """
+    Returns the config of the host listed under given name, or with given host url
+    """
+    for host_config in host_configs:
+        if target in (get_host_name(host_config), get_host_label(host_config)):
+            return host_config
+    return None
+
+
+def diff_host_configs(
+    old_host_configs: List[dict], new_host_configs: List[dict]
+) -> dict:
+    """
+    Returns host labels added, removed, whose config changed, and whose API credentials changed
+    between two nakivo_hosts lists
+    """
+    old = {get_host_label(host_config): host_config for host_config in old_host_configs}
+    new = {get_host_label(host_config): host_config for host_config in new_host_configs}
+    changed = [host for host in new if host in old and new[host] != old[host]]
+    return {
+        "added": [host for host in new if host not in old],
+        "removed": [host for host in old if host not in new],
+        "changed": changed,
+        "reconnected": [
+            host
+            for host in changed
+            if any(new[host].get(key) != old[host].get(key) for key in CLIENT_KEYS)
+        ],
+    }
+
+
+def get_session_idle_timeout(config: dict) -> float:
+    """
+    Returns after how many seconds an unused Nakivo API session is closed
+    """
+    try:
+        return float(config["collector"]["session_idle_timeout"])
+    except (AttributeError, ValueError, TypeError, KeyError):
+        return DEFAULT_SESSION_IDLE_TIMEOUT
+
+
+def get_collector_settings(config: dict) -> tuple[int, int]:
+    """
+    Returns max concurrency and per host timeout from the collector config section
+    """
+    try:
+        max_concurrency = int(config["collector"]["max_concurrency"])
+    except (AttributeError, ValueError, TypeError, KeyError):
+        max_concurrency = DEFAULT_MAX_CONCURRENCY
+    try:
+        host_timeout = float(config["collector"]["host_timeout"])
+    except (AttributeError, ValueError, TypeError, KeyError):
+        host_timeout = DEFAULT_HOST_TIMEOUT
+    return max(max_concurrency, 1), host_timeout
+
+
+def get_breaker_settings(config: dict) -> tuple[int, float, float]:
+    """
+    Returns after how many consecutive failures a host is skipped, and first and maximal cooldown
+    """
+    try:
+        failures = int(config["collector"]["breaker_failures"])
+    except (AttributeError, ValueError, TypeError, KeyError):
+        failures = DEFAULT_BREAKER_FAILURES
+    try:
+        backoff = float(config["collector"]["breaker_backoff"])
+    except (AttributeError, ValueError, TypeError, KeyError):
+        backoff = DEFAULT_BREAKER_BACKOFF
+    try:
+        max_backoff = float(config["collector"]["breaker_max_backoff"])
+    except (AttributeError, ValueError, TypeError, KeyError):
+        max_backoff = DEFAULT_BREAKER_MAX_BACKOFF
+    return failures, backoff, max(max_backoff, backoff)
+
+
+def add_host_status(status: MetricSet, host: str, up: int) -> MetricSet:
+    """
+    Adds whether a host could be collected, and whether it's currently skipped after failures
+    """
+    labels = (("host", host),)
+    status.add(
+        "nakivo_up",
+        "Could the Nakivo host be scraped in time",
+        labels,
+        up,
+    )
+    status.add(
+        "nakivo_circuit_breaker_open",
+        "Is the Nakivo host skipped after consecutive failures",
+        labels,
+        1 if api_registry.get_breaker(host).is_open else 0,
+    )
+    return status
+
+
+def get_stale_data(host: str) -> Optional[MetricSet]:
+    """
+    Returns last known good data of a host that couldn't be collected, if any
+    """
+    return data_cache.get_host(host) or None
+
+
+def apply_collector_settings(config: dict) -> None:
+    """
+    Applies collector settings to the shared API registry, data cache and self metrics,
+    including Nakivo sessions and circuit breakers of hosts already collected
+    """
+    api_registry.configure(
+        get_session_idle_timeout(config),
+        # A single HTTP call can't outlast the host deadline
+        get_collector_settings(config)[1],
+        *get_breaker_settings(config),
+    )
+    data_cache.max_staleness = get_max_staleness(config)
+    self_metrics.enabled = get_self_metrics_enabled(config)
+
+
+def collect_nakivo_hosts(
+    host_configs: List[dict],
+    max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+    host_timeout: float = DEFAULT_HOST_TIMEOUT,
+    include_self_metrics: bool = True,
+) -> List[MetricSet]:
+    """
+    Scrapes multiple Nakivo hosts concurrently in a bounded thread pool
+
+    Every host gets its own deadline which starts when its scraping begins.
+    Hosts that miss their deadline or fail are reported with nakivo_up 0 without
+    holding up the other hosts
+    """
+    started = {}
+
+    def _scrape(index: int, host_config: dict):
+        started[index] = time.monotonic()
+        data = None
+        try:
+            data = get_nakivo_data(host_config)
+        finally:
+            self_metrics.observe_collection(
+                get_host_label(host_config),
+                time.monotonic() - started[index],
+                not data,
+            )
+        return data
+
+    executor = ThreadPoolExecutor(
+        max_workers=max_concurrency, thread_name_prefix="nakivo_scrape"
+    )
+    futures = {
+        executor.submit(_scrape, index, host_config): index
+        for index, host_config in enumerate(host_configs)
+    }
+    results = {}
+    pending = set(futures)
+    while pending:
+        # Wake up when the next started host reaches its deadline
+        now = time.monotonic()
+        deadlines = [
+            started[futures[future]] + host_timeout
+            for future in pending
+            if futures[future] in started
+        ]
+        timeout = max(min(deadlines) - now, 0) if deadlines else host_timeout
+        done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+        for future in done:
+            try:
+                results[futures[future]] = future.result()
+            except Exception as exc:
+                host = get_host_label(host_configs[futures[future]])
+                logger.error(f"Scraping {host} failed: {exc}")
+                logger.debug("Trace", exc_info=True)
+                results[futures[future]] = None
+        now = time.monotonic()
+        for future in list(pending):
+            index = futures[future]
+            if index in started and now - started[index] >= host_timeout:
+                logger.error(
+                    f"Scraping {get_host_label(host_configs[index])} did not finish within {host_timeout}s"
+                )
+                results[index] = None
+                pending.discard(future)
+    # Don't wait for hosts that missed their deadline, they will finish in background
+    executor.shutdown(wait=False, cancel_futures=True)
+
+    status = MetricSet()
+    for index, host_config in enumerate(host_configs):
+        add_host_status(
+            status, get_host_label(host_config), 1 if results.get(index) else 0
+        )
+    # Hosts that failed or missed their deadline are served from last known good data
+    # Their collection may still finish in background and refresh it for the next scrape
+    metric_sets = [status] + [
+        results.get(index) or get_stale_data(get_host_label(host_config))
+        for index, host_config in enumerate(host_configs)
+    ]
+    if include_self_metrics and self_metrics.enabled:
+        metric_sets.append(self_metrics.collect())
+    return metric_sets
+
+
+def get_nakivo_hosts_data(
+    host_configs: List[dict],
+    max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+    host_timeout: float = DEFAULT_HOST_TIMEOUT,
+) -> str:
+    """
+    Scrapes multiple Nakivo hosts and renders them in prometheus text format
+    """
+    return render_text(
+        collect_nakivo_hosts(host_configs, max_concurrency, host_timeout)
+    )
 
 
 def main():
@@ -282,9 +935,10 @@ This is free software, and you are welcome to redistribute it under certain cond
         logger.critical(f"Cannot load configuration file {config_file}")
         sys.exit(1)
 
+    max_concurrency, host_timeout = get_collector_settings(config)
+    apply_collector_settings(config)
     try:
-        for nakivo_host in config["nakivo_hosts"]:
-            get_nakivo_data(nakivo_host)
+        get_nakivo_hosts_data(config["nakivo_hosts"], max_concurrency, host_timeout)
     except KeyError:
         logger.critical("Bogus configuration file. Missing nakivo_hosts key.")
         sys.exit(1)
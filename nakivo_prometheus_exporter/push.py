@@ -0,0 +1,339 @@
+#! /usr/bin/env python
+#  -*- coding: utf-8 -*-
+#
+# This file is part of nakivo_prometheus_exporter
+
+__appname__ = "nakivo_prometheus_exporter"
+__author__ = "Orsiris de Jong"
+__site__ = "https://www.github.com/netinvent/nakivo_prometheus_exporter"
+__description__ = "Naviko API Prometheus data exporter"
+__copyright__ = "Copyright (C) 2024 NetInvent"
+__license__ = "GPL-3.0-only"
+__build__ = "2026101701"
+
+
+import sys
+import os
+import time
+from argparse import ArgumentParser
+from pathlib import Path
+from typing import Iterable, Iterator, List, Optional, Tuple
+from urllib.parse import quote
+from logging import getLogger
+import requests
+
+# Fix dev env module import
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from nakivo_prometheus_exporter.prom_parser import (
+    load_config_file,
+    collect_nakivo_hosts,
+    get_collector_settings,
+    apply_collector_settings,
+)
+from nakivo_prometheus_exporter.exposition import (
+    MetricSet,
+    iter_histogram_series,
+    merge_families,
+    render_text,
+    _varint,
+    _field_bytes,
+    _field_string,
+    _field_varint,
+    _field_double,
+)
+from nakivo_prometheus_exporter.__debug__ import _DEBUG
+from ofunctions.logger_utils import logger_get_logger
+
+try:
+    import snappy
+except ImportError:
+    # Remote write payloads are then sent as uncompressed snappy blocks
+    snappy = None
+
+logger = getLogger()
+
+# How often (seconds) Nakivo hosts are collected and pushed
+DEFAULT_PUSH_INTERVAL = 300
+# How many series are sent per remote_write request
+DEFAULT_BATCH_SIZE = 5000
+# How many times a failed push is retried, first retry waits retry_backoff seconds, then twice as long
+DEFAULT_RETRIES = 3
+DEFAULT_RETRY_BACKOFF = 1
+# How long (seconds) a single push request may take
+DEFAULT_PUSH_TIMEOUT = 30
+
+REMOTE_WRITE_HEADERS = {
+    "Content-Type": "application/x-protobuf",
+    "Content-Encoding": "snappy",
+    "X-Prometheus-Remote-Write-Version": "0.1.0",
+    "User-Agent": __appname__,
+}
+PUSHGATEWAY_HEADERS = {
+    "Content-Type": "text/plain; version=0.0.4; charset=utf-8",
+    "User-Agent": __appname__,
+}
+
+Series = Tuple[Tuple[Tuple[str, str], ...], float, int]
+
+
+def snappy_compress(data: bytes) -> bytes:
+    """
+    Snappy block compression, with python-snappy when installed
+    Otherwise data is stored as literals, which is valid snappy, only without compression
+    """
+    if snappy:
+        return snappy.compress(data)
+    chunks = [_varint(len(data))]
+    for index in range(0, len(data), 65536):
+        literal = data[index : index + 65536]
+        length = len(literal) - 1
+        if length < 60:
+            chunks.append(bytes((length << 2,)))
+        elif length < 256:
+            chunks.append(bytes((60 << 2, length)))
+        else:
+            chunks.append(bytes((61 << 2,)) + length.to_bytes(2, "little"))
+        chunks.append(literal)
+    return b"".join(chunks)
+
+
+def iter_series(metric_sets: Iterable[MetricSet], timestamp: int) -> Iterator[Series]:
+    """
+    Yields every sample as a remote write series: sorted labels including __name__, value,
+    and timestamp in milliseconds (sample timestamp if any, else given collection timestamp)
+    """
+    for name, (header, families) in merge_families(metric_sets).items():
+        for family in families:
+            for sample in family.samples:
+                sample_timestamp = (
+                    int(sample.timestamp * 1000)
+                    if sample.timestamp is not None
+                    else timestamp
+                )
+                if header.type == "histogram":
+                    series = iter_histogram_series(name, sample.labels, sample.value)
+                else:
+                    series = ((name, sample.labels, sample.value),)
+                for series_name, labels, value in series:
+                    yield (
+                        tuple(sorted((("__name__", series_name),) + tuple(labels))),
+                        float("nan") if value is None else float(value),
+                        sample_timestamp,
+                    )
+
+
+def encode_write_request(series: List[Series]) -> bytes:
+    """
+    Encodes series as a prometheus.WriteRequest protobuf message
+    """
+    data = []
+    for labels, value, timestamp in series:
+        # prometheus.TimeSeries: repeated Label labels = 1, repeated Sample samples = 2
+        time_series = [
+            _field_bytes(1, _field_string(1, name) + _field_string(2, str(label)))
+            for name, label in labels
+        ]
+        time_series.append(
+            _field_bytes(2, _field_double(1, value) + _field_varint(2, timestamp))
+        )
+        data.append(_field_bytes(1, b"".join(time_series)))
+    return b"".join(data)
+
+
+class Pusher:
+    """
+    Pushes collected metric sets to a Prometheus remote_write endpoint, or to a Pushgateway
+    """
+
+    def __init__(
+        self,
+        url: str,
+        mode: str = "remote_write",
+        job: str = __appname__,
+        grouping: Optional[dict] = None,
+        username: Optional[str] = None,
+        password: Optional[str] = None,
+        cert_verify: bool = True,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        retries: int = DEFAULT_RETRIES,
+        retry_backoff: float = DEFAULT_RETRY_BACKOFF,
+        timeout: float = DEFAULT_PUSH_TIMEOUT,
+    ):
+        if mode not in ("remote_write", "pushgateway"):
+            raise ValueError(f"Unknown push mode {mode}")
+        self.url = url
+        self.mode = mode
+        self.job = job
+        self.grouping = grouping or {}
+        self.batch_size = max(batch_size, 1)
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.verify = cert_verify
+        if username:
+            self.session.auth = (username, password or "")
+
+    def push(self, metric_sets: List[MetricSet]) -> bool:
+        if self.mode == "pushgateway":
+            return self.push_gateway(metric_sets)
+        return self.remote_write(metric_sets)
+
+    def remote_write(self, metric_sets: List[MetricSet]) -> bool:
+        """
+        Sends samples in batches of batch_size series, returns whether every batch was accepted
+        """
+        series = list(iter_series(metric_sets, int(time.time() * 1000)))
+        success = True
+        for index in range(0, len(series), self.batch_size):
+            data = snappy_compress(
+                encode_write_request(series[index : index + self.batch_size])
+            )
+            success = (
+                self._send("POST", self.url, data, REMOTE_WRITE_HEADERS) and success
+            )
+        logger.info(f"Pushed {len(series)} series to {self.url}")
+        return success
+
+    def push_gateway(self, metric_sets: List[MetricSet]) -> bool:
+        """
+        Replaces every metric of our grouping key on the Pushgateway
+        """
+        url = f"{self.url.rstrip('/')}/metrics/job/{quote(self.job, safe='')}"
+        for name, value in self.grouping.items():
+            url += f"/{quote(str(name), safe='')}/{quote(str(value), safe='')}"
+        data = render_text(metric_sets).encode("utf-8")
+        return self._send("PUT", url, data, PUSHGATEWAY_HEADERS)
+
+    def _send(self, method: str, url: str, data: bytes, headers: dict) -> bool:
+        """
+        Sends data, retrying on connection errors, HTTP 429 and 5xx with exponential backoff
+        Other errors mean data is refused and won't be accepted on retry either
+        """
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(self.retry_backoff * 2 ** (attempt - 1))
+            try:
+                response = self.session.request(
+                    method, url, data=data, headers=headers, timeout=self.timeout
+                )
+            except requests.RequestException as exc:
+                logger.error(f"Cannot push to {url}: {exc}")
+                continue
+            if response.status_code < 300:
+                return True
+            logger.error(
+                f"Push to {url} failed with HTTP {response.status_code}: {response.text[:200]}"
+            )
+            if response.status_code != 429 and response.status_code < 500:
+                return False
+        return False
+
+
+def get_pusher(config: dict) -> Pusher:
+    """
+    Returns a pusher from the push config section
+    """
+    try:
+        push_config = config["push"]
+        url = push_config["url"]
+    except (AttributeError, ValueError, TypeError, KeyError):
+        raise ValueError("No push url configured")
+
+    def _get(key, default):
+        try:
+            value = push_config[key]
+            return default if value is None else value
+        except (AttributeError, ValueError, TypeError, KeyError):
+            return default
+
+    return Pusher(
+        url,
+        mode=_get("mode", "remote_write"),
+        job=_get("job", __appname__),
+        grouping=dict(_get("grouping", {})),
+        username=_get("username", None),
+        password=_get("password", None),
+        cert_verify=_get("cert_verify", True) is not False,
+        batch_size=int(_get("batch_size", DEFAULT_BATCH_SIZE)),
+        retries=int(_get("retries", DEFAULT_RETRIES)),
+        retry_backoff=float(_get("retry_backoff", DEFAULT_RETRY_BACKOFF)),
+        timeout=float(_get("timeout", DEFAULT_PUSH_TIMEOUT)),
+    )
+
+
+def get_push_interval(config: dict) -> float:
+    try:
+        return float(config["push"]["interval"])
+    except (AttributeError, ValueError, TypeError, KeyError):
+        return DEFAULT_PUSH_INTERVAL
+
+
+def main():
+    logger_get_logger(debug=_DEBUG)
+    default_config_file = "nakivo_prometheus_exporter.yaml"
+
+    parser = ArgumentParser(
+        prog=f"{__appname__}_push",
+        description="""Naviko API Prometheus exporter, push mode\n
+Collects Nakivo hosts on a schedule and pushes them to Prometheus remote_write or a Pushgateway\n
+This program is distributed under the GNU General Public License and comes with ABSOLUTELY NO WARRANTY.\n
+This is free software, and you are welcome to redistribute it under certain conditions; Please type --license for more info.""",
+    )
+    parser.add_argument(
+        "-c",
+        "--config-file",
+        dest="config_file",
+        type=str,
+        default=default_config_file,
+        required=False,
+        help=f"Path to YAML configuration file (defaults to current dir {default_config_file})",
+    )
+    parser.add_argument(
+        "--once", action="store_true", help="Collect and push once, then exit"
+    )
+    args = parser.parse_args()
+
+    config_file = Path(args.config_file)
+    config = load_config_file(config_file) if config_file.exists() else False
+    if not config:
+        logger.critical(f"Cannot load configuration file {config_file}")
+        sys.exit(1)
+    try:
+        logger_get_logger(config["http_server"]["log_file"], debug=_DEBUG)
+    except (AttributeError, KeyError, IndexError, TypeError):
+        pass
+    try:
+        host_configs = list(config["nakivo_hosts"])
+        pusher = get_pusher(config)
+    except KeyError:
+        logger.critical("Bogus configuration file. Missing nakivo_hosts key.")
+        sys.exit(1)
+    except ValueError as exc:
+        logger.critical(f"Bogus push configuration: {exc}")
+        sys.exit(1)
+
+    max_concurrency, host_timeout = get_collector_settings(config)
+    apply_collector_settings(config)
+    interval = get_push_interval(config)
+    logger.info(f"Pushing {len(host_configs)} hosts to {pusher.url} every {interval}s")
+    try:
+        while True:
+            start = time.monotonic()
+            try:
+                success = pusher.push(
+                    collect_nakivo_hosts(host_configs, max_concurrency, host_timeout)
+                )
+            except Exception as exc:
+                logger.error(f"Collecting and pushing failed: {exc}")
+                logger.debug("Trace", exc_info=True)
+                success = False
+            if args.once:
+                sys.exit(0 if success else 1)
+            time.sleep(max(interval - (time.monotonic() - start), 0))
+    except KeyboardInterrupt:
+        logger.info("Push mode interrupted")
+
+
+if __name__ == "__main__":
+    main()
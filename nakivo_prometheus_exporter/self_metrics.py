@@ -0,0 +1,200 @@
+#! /usr/bin/env python
+#  -*- coding: utf-8 -*-
+#
+# This file is part of nakivo_prometheus_exporter
+
+__appname__ = "nakivo_prometheus_exporter"
+__author__ = "Orsiris de Jong"
+__site__ = "https://www.github.com/netinvent/nakivo_prometheus_exporter"
+__description__ = "Naviko API Prometheus data exporter"
+__copyright__ = "Copyright (C) 2024 NetInvent"
+__license__ = "GPL-3.0-only"
+__build__ = "2026101701"
+
+
+import bisect
+import threading
+from typing import Tuple, Union
+from nakivo_prometheus_exporter.exposition import (
+    HistogramValue,
+    Labels,
+    MetricSet,
+)
+
+
+# Histogram upper bounds (seconds) for RPC, collection and render durations
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50)
+
+
+def get_self_metrics_enabled(config: dict) -> bool:
+    """
+    Returns whether the exporter exposes its own metrics along with Nakivo data
+    """
+    try:
+        return config["collector"]["self_metrics"] is not False
+    except (AttributeError, ValueError, TypeError, KeyError):
+        return True
+
+
+class SelfMetrics:
+    """
+    Thread safe store of the exporter's own metrics: where collection time goes, and how well caches work
+    """
+
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.enabled = True
+        self._lock = threading.Lock()
+        # (name, labels): [per bucket counts, sum, count]
+        self._histograms = {}
+        # (name, labels): value
+        self._counters = {}
+        self._documentation = {}
+
+    def observe(
+        self, name: str, documentation: str, labels: Labels, value: float
+    ) -> None:
+        if not self.enabled:
+            return
+        with self._lock:
+            self._documentation[name] = documentation
+            try:
+                histogram = self._histograms[(name, labels)]
+            except KeyError:
+                histogram = [[0] * len(self.buckets), 0.0, 0]
+                self._histograms[(name, labels)] = histogram
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                histogram[0][index] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def inc(
+        self,
+        name: str,
+        documentation: str,
+        labels: Labels,
+        value: Union[int, float] = 1,
+    ) -> None:
+        if not self.enabled:
+            return
+        with self._lock:
+            self._documentation[name] = documentation
+            self._counters[(name, labels)] = (
+                self._counters.get((name, labels), 0) + value
+            )
+
+    def observe_rpc(
+        self,
+        host: str,
+        method: str,
+        duration: float,
+        response_bytes: int = 0,
+        error: bool = False,
+    ) -> None:
+        labels = (("host", host), ("method", method))
+        self.observe(
+            "nakivo_exporter_rpc_duration_seconds",
+            "How long Nakivo API calls take",
+            labels,
+            duration,
+        )
+        if response_bytes:
+            self.inc(
+                "nakivo_exporter_rpc_response_bytes_total",
+                "How many bytes Nakivo API replied",
+                labels,
+                response_bytes,
+            )
+        if error:
+            self.inc(
+                "nakivo_exporter_rpc_errors_total",
+                "How many Nakivo API calls failed",
+                labels,
+            )
+
+    def observe_collection(self, host: str, duration: float, error: bool) -> None:
+        labels = (("host", host),)
+        self.observe(
+            "nakivo_exporter_collection_duration_seconds",
+            "How long collecting a Nakivo host takes",
+            labels,
+            duration,
+        )
+        if error:
+            self.inc(
+                "nakivo_exporter_collection_errors_total",
+                "How many Nakivo host collections failed or missed their deadline",
+                labels,
+            )
+
+    def observe_render(self, exposition_format: str, duration: float) -> None:
+        self.observe(
+            "nakivo_exporter_render_duration_seconds",
+            "How long rendering collected data takes",
+            (("format", exposition_format),),
+            duration,
+        )
+
+    def cache_access(self, cache: str, hits: int = 0, misses: int = 0) -> None:
+        labels = (("cache", cache),)
+        self.inc(
+            "nakivo_exporter_cache_hits_total",
+            "How many cache lookups hit",
+            labels,
+            hits,
+        )
+        self.inc(
+            "nakivo_exporter_cache_misses_total",
+            "How many cache lookups missed",
+            labels,
+            misses,
+        )
+
+    def collect(self) -> MetricSet:
+        """
+        Returns a snapshot of our own metrics
+        """
+        metrics = MetricSet()
+        with self._lock:
+            for (name, labels), (counts, total, count) in self._histograms.items():
+                cumulative = 0
+                buckets = []
+                for upper_bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    buckets.append((upper_bound, cumulative))
+                metrics.add(
+                    name,
+                    self._documentation[name],
+                    labels,
+                    HistogramValue(tuple(buckets), round(total, 6), count),
+                    metric_type="histogram",
+                )
+            for (name, labels), value in self._counters.items():
+                metrics.add(
+                    name,
+                    self._documentation[name],
+                    labels,
+                    value,
+                    metric_type="counter",
+                )
+            hits = {
+                labels: value
+                for (name, labels), value in self._counters.items()
+                if name == "nakivo_exporter_cache_hits_total"
+            }
+            for labels, hit_count in hits.items():
+                lookups = hit_count + self._counters.get(
+                    ("nakivo_exporter_cache_misses_total", labels), 0
+                )
+                metrics.add(
+                    "nakivo_exporter_cache_hit_ratio",
+                    "Ratio of cache lookups that hit since start",
+                    labels,
+                    round(hit_count / lookups, 4) if lookups else 0,
+                )
+        return metrics
+
+
+# Metrics of this process, filled by Nakivo API calls, collections and rendering
+self_metrics = SelfMetrics()
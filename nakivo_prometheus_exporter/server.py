@@ -118,7 +118,8 @@ This is free software, and you are welcome to redistribute it under certain cond
                 return self.application
 
         server_args = {
-            "workers": 4,  # Don't run multiple workers since we don't have shared variables yet (multiprocessing.cpu_count() * 2) + 1,
+            # Only one worker collects Nakivo data, others serve its snapshot from the shared store
+            "workers": 4,
             "bind": f"{listen}:{port}" if listen else "0.0.0.0:8080",
             "worker_class": "uvicorn.workers.UvicornWorker",
         }
@@ -0,0 +1,230 @@
+#! /usr/bin/env python
+#  -*- coding: utf-8 -*-
+#
+# This file is part of nakivo_prometheus_exporter
+
+__appname__ = "nakivo_prometheus_exporter"
+__author__ = "Orsiris de Jong"
+__site__ = "https://www.github.com/netinvent/nakivo_prometheus_exporter"
+__description__ = "Naviko API Prometheus data exporter"
+__copyright__ = "Copyright (C) 2024 NetInvent"
+__license__ = "GPL-3.0-only"
+__build__ = "2026101701"
+
+
+import os
+import hashlib
+import tempfile
+import threading
+from pathlib import Path
+from stat import S_IMODE, S_ISDIR
+from typing import Iterable, Iterator, Optional, Union
+from logging import getLogger
+from nakivo_prometheus_exporter.compression import ENCODING_SUFFIXES, compress_file
+
+try:
+    import fcntl
+except ImportError:
+    # Windows runs a single worker, there's nobody to share with
+    fcntl = None
+
+logger = getLogger()
+
+SNAPSHOT_FILE = "metrics.prom"
+STREAM_CHUNK_SIZE = 65536
+LEADER_LOCK_FILE = "collector.lock"
+
+
+def get_shared_store_dir(config: dict, config_file: str) -> Path:
+    """
+    Returns the directory where gunicorn workers share their snapshot
+    Defaults to a directory unique to the configuration file, so two exporters don't mix their data,
+    in our private runtime directory (systemd RuntimeDirectory=, or XDG_RUNTIME_DIR) when there is one
+    """
+    try:
+        if config["collector"]["shared_store_dir"]:
+            return Path(config["collector"]["shared_store_dir"])
+    except (AttributeError, ValueError, TypeError, KeyError):
+        pass
+    config_hash = hashlib.sha1(
+        str(Path(config_file).absolute()).encode("utf-8")
+    ).hexdigest()[:12]
+    runtime_dir = (
+        os.environ.get("RUNTIME_DIRECTORY", "").split(":")[0]
+        or os.environ.get("XDG_RUNTIME_DIR")
+        or tempfile.gettempdir()
+    )
+    return Path(runtime_dir) / f"nakivo_prometheus_exporter_{config_hash}"
+
+
+def check_store_dir(directory: Path) -> None:
+    """
+    Refuses a store directory other local users could have created or could write to,
+    since they could then hold the leader lock, or plant the snapshot every worker serves
+    """
+    if not hasattr(os, "getuid"):
+        return
+    stat = os.lstat(directory)
+    if not S_ISDIR(stat.st_mode):
+        raise PermissionError(f"Shared store {directory} is not a directory")
+    if stat.st_uid != os.getuid():
+        raise PermissionError(
+            f"Shared store {directory} is owned by uid {stat.st_uid}, not by us"
+        )
+    if stat.st_mode & 0o022:
+        raise PermissionError(
+            f"Shared store {directory} is writable by other users (mode {S_IMODE(stat.st_mode):o})"
+        )
+
+
+class SnapshotStore:
+    """
+    Stores rendered payloads as files so every worker process serves the same data
+    Files are replaced atomically and only read again when they changed
+    """
+
+    def __init__(self, directory: Path):
+        self.directory = Path(directory)
+        self.directory.mkdir(mode=0o700, parents=True, exist_ok=True)
+        check_store_dir(self.directory)
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def write(self, data: Union[str, bytes], name: str = SNAPSHOT_FILE) -> None:
+        self.write_chunks([data], name)
+
+    def write_chunks(
+        self, chunks: Iterable[Union[str, bytes]], name: str = SNAPSHOT_FILE
+    ) -> None:
+        """
+        Writes chunks as they are produced, so the whole payload never needs to be held in memory
+        """
+        path = self.directory / name
+        try:
+            file_descriptor, tmp_path = tempfile.mkstemp(
+                dir=self.directory, prefix=f".{name}."
+            )
+            with os.fdopen(file_descriptor, "wb") as file_handle:
+                for chunk in chunks:
+                    if isinstance(chunk, str):
+                        chunk = chunk.encode("utf-8")
+                    file_handle.write(chunk)
+            os.replace(tmp_path, path)
+        except OSError as exc:
+            logger.error(f"Cannot write shared snapshot {path}: {exc}")
+
+    @staticmethod
+    def get_name(name: str = SNAPSHOT_FILE, encoding: Optional[str] = None) -> str:
+        """
+        Returns the file name of a payload, compressed with given encoding
+        """
+        if encoding:
+            return f"{name}.{ENCODING_SUFFIXES[encoding]}"
+        return name
+
+    def compress(self, encoding: str, name: str = SNAPSHOT_FILE) -> None:
+        """
+        Stores a compressed copy of a payload, so it's compressed once instead of on every request
+        """
+        path = self.directory / self.get_name(name, encoding)
+        try:
+            file_descriptor, tmp_path = tempfile.mkstemp(
+                dir=self.directory, prefix=f".{path.name}."
+            )
+            with open(self.directory / name, "rb") as source, os.fdopen(
+                file_descriptor, "wb"
+            ) as destination:
+                compress_file(source, destination, encoding)
+            os.replace(tmp_path, path)
+        except OSError as exc:
+            logger.error(f"Cannot write shared snapshot {path}: {exc}")
+
+    def exists(self, name: str = SNAPSHOT_FILE) -> bool:
+        return (self.directory / name).is_file()
+
+    def iter_chunks(
+        self, name: str = SNAPSHOT_FILE, chunk_size: int = STREAM_CHUNK_SIZE
+    ) -> Iterator[bytes]:
+        """
+        Streams a stored payload without loading it in memory
+        Replacing the file while streaming doesn't affect an already opened file
+        """
+        path = self.directory / name
+        try:
+            with open(path, "rb") as file_handle:
+                while True:
+                    chunk = file_handle.read(chunk_size)
+                    if not chunk:
+                        break
+                    yield chunk
+        except FileNotFoundError:
+            # Nothing has been collected yet
+            return
+        except OSError as exc:
+            logger.error(f"Cannot read shared snapshot {path}: {exc}")
+
+    def read(self, name: str = SNAPSHOT_FILE) -> bytes:
+        path = self.directory / name
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return b""
+        # Every write replaces the file, so inode and mtime tell us whether it changed
+        key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            cached = self._cache.get(name)
+            if cached and cached[0] == key:
+                return cached[1]
+        try:
+            with open(path, "rb") as file_handle:
+                data = file_handle.read()
+        except OSError as exc:
+            logger.error(f"Cannot read shared snapshot {path}: {exc}")
+            return b""
+        with self._lock:
+            self._cache[name] = (key, data)
+        return data
+
+
+class LeaderLock:
+    """
+    Non blocking inter process lock, so only one worker collects Nakivo data
+    The lock is released by the OS when the holding process dies
+    """
+
+    def __init__(self, directory: Path):
+        self.path = Path(directory) / LEADER_LOCK_FILE
+        self._file_handle = None
+
+    @property
+    def acquired(self) -> bool:
+        return self._file_handle is not None
+
+    def acquire(self) -> bool:
+        if self.acquired:
+            return True
+        if fcntl is None:
+            self._file_handle = True
+            return True
+        # Never follow a symlink planted in place of our lock file
+        file_descriptor = os.open(
+            self.path,
+            os.O_WRONLY | os.O_CREAT | os.O_APPEND | getattr(os, "O_NOFOLLOW", 0),
+            0o600,
+        )
+        file_handle = os.fdopen(file_descriptor, "a", encoding="utf-8")
+        try:
+            fcntl.flock(file_handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            file_handle.close()
+            return False
+        self._file_handle = file_handle
+        return True
+
+    def release(self) -> None:
+        if self._file_handle is None:
+            return
+        if fcntl is not None:
+            fcntl.flock(self._file_handle, fcntl.LOCK_UN)
+            self._file_handle.close()
+        self._file_handle = None
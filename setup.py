@@ -100,7 +100,8 @@ long_description = _read_file("README.md")
 
 
 console_scripts = [
-    "nakivo_prometheus_exporter = nakivo_prometheus_exporter.server:main"
+    "nakivo_prometheus_exporter = nakivo_prometheus_exporter.server:main",
+    "nakivo_prometheus_exporter_push = nakivo_prometheus_exporter.push:main",
 ]
 setuptools.setup(
     name=PACKAGE_NAME,